@@ -1,9 +1,128 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, json, jsonify
+import os
+import io
+import re
+import hashlib
+import argparse
+import threading
+import collections
+from flask import Flask, Response, request, json, jsonify
+
+# local import
+import tokens
+from tokens import Token, Spell, loadFromRst, all_skills
+from util import jenv, configureImgCache, configureImgEncoder, configureAssetCache, configureTemplateCache, assetCache, imgCache
 
 app = Flask(__name__)
+# same defaults as the tokens.py command line
+app.config.setdefault('TOKENS_DELIVERY', False)
+app.config.setdefault('TOKENS_THIN', False)
+app.config.setdefault('TOKENS_IMG_CACHE', os.path.join('build', 'imgcache'))
+app.config.setdefault('TOKENS_IMG_CACHE_SIZE', 256) # MB
+app.config.setdefault('TOKENS_IMG_MEMORY_SIZE', 128) # MB
+app.config.setdefault('TOKENS_IMG_MAX_SIZE', 0) # pixels
+app.config.setdefault('TOKENS_IMG_COLORS', 0)
+app.config.setdefault('TOKENS_IMG_OPTIMIZE', False)
+app.config.setdefault('TOKENS_TEMPLATE_CACHE', os.path.join('build', 'jinja'))
+app.config.setdefault('TOKENS_RESPONSE_CACHE_SIZE', 64) # MB
+
+class ResponseCache(object):
+	"""Built rptok files, keyed by the request ETag, least recently used first out of max_bytes."""
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.items = collections.OrderedDict() # etag => data
+		self.building = {} # etag => [build lock, number of requests using it]
+		self.hits, self.misses, self.evictions, self.not_modified, self.coalesced = 0, 0, 0, 0, 0
+		self._lock = threading.Lock()
+
+	def __repr__(self): return 'ResponseCache<%s items, %s bytes>' % (len(self.items), self.bytes)
+
+	def get(self, key):
+		with self._lock:
+			item = self.items.pop(key, None)
+			if item is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.items[key] = item # most recently used
+			return item
+
+	def put(self, key, data):
+		if len(data) > self.max_bytes: return
+		with self._lock:
+			old = self.items.pop(key, None)
+			if old: self.bytes -= len(old)
+			self.items[key] = data
+			self.bytes += len(data)
+			while self.bytes > self.max_bytes:
+				_, evicted = self.items.popitem(last=False)
+				self.bytes -= len(evicted)
+				self.evictions += 1
+
+	def fill(self, key, build):
+		"""Return the data of key, on a miss build it and put it, one build at a time per key.
+
+		The requests waiting on the build of the same key are served its data."""
+		data = self.get(key)
+		if data is not None: return data
+		with self._lock:
+			entry = self.building.setdefault(key, [threading.Lock(), 0])
+			entry[1] += 1
+		try:
+			with entry[0]:
+				with self._lock:
+					data = self.items.get(key)
+					if data is not None: self.coalesced += 1
+				if data is None:
+					data = build()
+					self.put(key, data)
+				return data
+		finally:
+			with self._lock:
+				entry[1] -= 1
+				if not entry[1]: del self.building[key]
+
+	def notModified(self):
+		with self._lock: self.not_modified += 1
+
+	def metrics(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {'items': len(self.items), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+				'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'not_modified': self.not_modified, 'coalesced': self.coalesced,
+				'hit_ratio': float(self.hits)/lookups if lookups else 0.0}
+
+responses = None
+
+_warm = threading.Lock()
+_warmed = []
+
+def warm():
+	"""Load once what the tokens need: spells, reference data, image index and templates."""
+	global responses # pylint: disable= W0603
+	with _warm:
+		if _warmed: return
+		responses = ResponseCache(app.config['TOKENS_RESPONSE_CACHE_SIZE']*2**20)
+		tokens.args = argparse.Namespace(delivery=app.config['TOKENS_DELIVERY'], zip_only=False, thin=app.config['TOKENS_THIN'])
+		configureImgCache(app.config['TOKENS_IMG_MEMORY_SIZE']*2**20)
+		configureImgEncoder(app.config['TOKENS_IMG_MAX_SIZE'], app.config['TOKENS_IMG_COLORS'], app.config['TOKENS_IMG_OPTIMIZE'])
+		configureAssetCache(app.config['TOKENS_IMG_CACHE'], app.config['TOKENS_IMG_CACHE_SIZE']*2**20)
+		configureTemplateCache(app.config['TOKENS_TEMPLATE_CACHE'])
+		with open(r'../5e-database/5e-SRD-Spells.json', 'r') as mfile:
+			Spell.spellDB = [Spell(spell) for spell in json.load(mfile)]
+		Spell.index()
+		all_skills()
+		Token.imgLib()
+		for name in ['content.template', 'properties.template', 'md5.template', 'prop.template', 'token_sheet.mtmacro']:
+			jenv().get_template(name)
+		app.logger.info("Ready: %s spells, %s" % (len(Spell.spellDB), Token.imgIndex))
+		_warmed.append(True)
+
+@app.before_first_request
+def _warmup(): warm()
 
 @app.route('/')
 def hello_world():
@@ -23,3 +142,83 @@ def mt():
 
 		return jsonify(request.get_json())
 	return "Got your get"
+
+def attachment(filename):
+	"""The Content-Disposition header of a file named after the posted monster, printable ascii only."""
+	return 'attachment; filename="%s"' % re.sub(r'[^\x20-\x7e]|["\\]', '_', filename)
+
+# the monster fields the token build reads without a default
+required = ['name', 'size', 'alignment', 'armor_class', 'hit_points', 'hit_dice', 'speed', 'senses', 'languages', 'challenge_rating',
+	'strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma']
+
+def monster():
+	"""Return the monster json of the request, posted as json or as a tome of beasts rst stat block.
+
+	Raise ValueError or TypeError if it's not a monster the tokens can be built from."""
+	js = request.get_json() if request.is_json else loadFromRst(io.StringIO(request.get_data(as_text=True)))
+	if not isinstance(js, dict): raise TypeError("the monster is not a json object")
+	missing = [field for field in required if js.get(field) is None]
+	if missing: raise ValueError("the monster has no %s" % ', '.join(missing))
+	return js
+
+def etag(tok):
+	"""The ETag of the token, computed before any build work.
+
+	Unlike the token fingerprint it doesn't load the image: the matched image
+	file is identified by its path, size and mtime. The spells follow from the
+	monster, the spell database is loaded once per process."""
+	path = tok.imgPath
+	stat = os.stat(path)
+	md5 = hashlib.md5(Token.sourcesDigest())
+	md5.update(json.dumps(tok.js, sort_keys=True))
+	md5.update(json.dumps([path, stat.st_size, stat.st_mtime]))
+	md5.update(str(tokens.args.delivery))
+	if tokens.args.thin: md5.update('thin')
+	return md5.hexdigest()
+
+@app.route('/token', methods=['POST'])
+def token():
+	"""Build the posted monster, reply with its rptok file.
+
+	The ETag is computed from the posted monster first, so a matching
+	If-None-Match gets a 304 without any build work. The same token is built
+	once, concurrent requests wait for that build, then it's served from the
+	response cache."""
+	try:
+		tok = Token(monster())
+		key = etag(tok)
+		disposition = attachment(os.path.basename(tok.filename))
+	except (KeyError, ValueError, TypeError) as e: # a malformed monster, a missing or mistyped field
+		app.logger.warning("Cannot load the posted monster: %r" % e)
+		return jsonify(error=str(e)), 400
+	if key in request.if_none_match:
+		responses.notModified()
+		response = Response(status=304)
+		response.set_etag(key)
+		return response
+	def build():
+		data = tok.rptok()
+		app.logger.info("Built %s" % tok)
+		return data
+	response = Response(responses.fill(key, build), mimetype='application/zip', headers={'Content-Disposition': disposition})
+	response.set_etag(key)
+	return response
+
+@app.route('/metrics')
+def metrics():
+	"""The service cache metrics."""
+	acache = assetCache()
+	return jsonify(responses=responses.metrics(), imgCache=imgCache.metrics(),
+		assetCache={'hits': acache.hits, 'misses': acache.misses} if acache else None)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='DnD 5e token build service')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=5000)
+	parser.add_argument('--delivery', '-d', action="store_true", default=False)
+	parser.add_argument('--thin', action="store_true", default=False, help='built tokens call the sheet on Lib:Addon5e')
+	args = parser.parse_args()
+	app.config['TOKENS_DELIVERY'] = args.delivery
+	app.config['TOKENS_THIN'] = args.thin
+	warm()
+	app.run(args.host, args.port, threaded=True)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Offline build benchmarks on a synthetic monster corpus.
+#
+#   python bench.py --monsters 1000 --images 20000 --save   # record the baseline
+#   python bench.py --monsters 1000 --images 20000          # compare against it
+
+import os
+import json
+import glob
+import random
+import shutil
+import codecs
+import argparse
+import timeit
+import logging
+from PIL import Image
+
+# local import
+import util
+import tokens
+from tokens import Token, Spell, loadFromRst
+from zone import Zone
+from cmpgn import Campaign, PSet
+
+log = util.getLogger(__name__)
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+abilities = [
+	('Strength', ['Athletics']),
+	('Dexterity', ['Acrobatics', 'Sleight of Hand', 'Stealth']),
+	('Constitution', []),
+	('Intelligence', ['Arcana', 'History', 'Investigation', 'Nature', 'Religion']),
+	('Wisdom', ['Animal Handling', 'Insight', 'Medicine', 'Perception', 'Survival']),
+	('Charisma', ['Deception', 'Intimidation', 'Performance', 'Persuasion']),
+]
+sizes = ['Tiny', 'Small', 'Medium', 'Large', 'Huge', 'Gargantuan']
+types = ['aberration', 'beast', 'construct', 'dragon', 'elemental', 'fey', 'fiend', 'giant', 'humanoid', 'monstrosity', 'undead']
+damages = ['acid', 'bludgeoning', 'cold', 'fire', 'lightning', 'necrotic', 'piercing', 'poison', 'slashing', 'thunder']
+syllables = ['gor', 'ath', 'ul', 'mek', 'zar', 'ith', 'bra', 'kul', 'vor', 'nym', 'dra', 'sha', 'tor', 'el', 'quo', 'rin']
+kinds = ['Bear', 'Goblin', 'Mage', 'Dragon', 'Wolf', 'Orc', 'Kobold', 'Ogre', 'Wight', 'Golem', 'Hag', 'Drake', 'Spider', 'Knight']
+
+class Corpus(object):
+	"""Synthetic monsters, spells, rst stat blocks and image libraries, laid out like the real data.
+
+	root/5e-database, root/imglib, root/GUI_Icons_png and root/open5e are the
+	builder sibling directories, root/work is the builder working directory."""
+	rstDir = os.path.join('open5e', 'legacy-source-content', 'monsters', 'tome-of-beasts')
+	def __init__(self, root, monsters=100, images=1000, seed=5, rst=0.1, spells=300):
+		self.root = root
+		self.params = {'monsters': monsters, 'images': images, 'seed': seed, 'rst': rst, 'spells': spells, 'version': 1}
+		self.rnd = random.Random(seed)
+
+	def __repr__(self): return 'Corpus<%s,%s monsters,%s images>' % (self.root, self.params['monsters'], self.params['images'])
+
+	@property
+	def work(self): return os.path.join(self.root, 'work')
+
+	def path(self, *p): return os.path.join(self.root, *p)
+
+	def word(self, n=2): return ''.join(self.rnd.choice(syllables) for _ in range(n)).capitalize()
+
+	def spell(self, name):
+		damage = '%sd%s %s damage' % (self.rnd.randint(1, 8), self.rnd.choice([4, 6, 8, 10, 12]), self.rnd.choice(damages))
+		return {'name': name, 'desc': ['The target takes %s. Make a ranged spell attack.' % damage, 'Some more lore.'],
+			'higher_level': ['The damage increases by 1d6 for each slot level above 1st.'],
+			'classes': [{'name': 'Wizard'}], 'school': {'name': 'Evocation'}, 'concentration': 'no', 'level': self.rnd.randint(0, 9),
+			'casting_time': '1 action', 'range': '120 feet', 'components': ['V', 'S'], 'duration': 'Instantaneous', 'ritual': 'no'}
+
+	def action(self, name, reach=5):
+		bonus, dice, sides = self.rnd.randint(2, 14), self.rnd.randint(1, 4), self.rnd.choice([4, 6, 8, 10, 12])
+		desc = 'Melee Weapon Attack: +%s to hit, reach %s ft., one target. Hit: %s (%sd%s + %s) %s damage.' % (
+			bonus, reach, dice*(sides+1)/2+bonus/2, dice, sides, bonus/2, self.rnd.choice(damages))
+		if self.rnd.random() < 0.3:
+			desc += ' plus %s (%sd6) %s damage.' % (self.rnd.randint(3, 14), self.rnd.randint(1, 4), self.rnd.choice(damages))
+		return {'name': name, 'desc': desc, 'attack_bonus': bonus, 'damage_dice': '%sd%s' % (dice, sides), 'damage_bonus': bonus/2}
+
+	def monster(self, index, name, spells):
+		js = {'index': index, 'name': name, 'size': self.rnd.choice(sizes), 'type': self.rnd.choice(types), 'subtype': '',
+			'alignment': 'unaligned', 'armor_class': self.rnd.randint(10, 22), 'hit_points': self.rnd.randint(5, 400),
+			'hit_dice': '%sd8' % self.rnd.randint(1, 30), 'speed': '30 ft., fly 60 ft.',
+			'damage_vulnerabilities': '', 'damage_resistances': self.rnd.choice(['', 'fire', 'cold; bludgeoning']),
+			'damage_immunities': '', 'condition_immunities': '', 'senses': 'darkvision 60 ft., passive Perception 12',
+			'languages': 'Common', 'challenge_rating': self.rnd.randint(0, 30),
+			'special_abilities': [{'name': '%s Sense' % self.word(), 'desc': 'The creature has advantage on checks.'}],
+			'actions': [{'name': 'Multiattack', 'desc': 'The creature makes two attacks.'}] + [self.action(self.word(), self.rnd.choice([5, 10])) for _ in range(self.rnd.randint(1, 4))],
+			'reactions': [], 'legendary_actions': []}
+		for attribute, _ in abilities: js[attribute.lower()] = self.rnd.randint(3, 30)
+		for _, skills in abilities:
+			for skill in skills:
+				if self.rnd.random() < 0.15: js[skill.lower()] = self.rnd.randint(1, 12)
+		for attribute, _ in abilities:
+			if self.rnd.random() < 0.2: js['%s_save' % attribute.lower()] = self.rnd.randint(1, 12)
+		if self.rnd.random() < 0.3:
+			known = self.rnd.sample(spells, min(10, len(spells)))
+			js['special_abilities'].append({'name': 'Spellcasting', 'desc': 'The creature is a 9th-level spellcaster. Its spellcasting ability is Intelligence (spell save DC 15, +7 to hit with spell attacks). '
+				'Cantrips (at will): %s\n1st level (4 slots): %s\n2nd level (3 slots): %s\n3rd level (3 slots): %s' % (
+				', '.join(known[:3]).lower(), ', '.join(known[3:6]).lower(), ', '.join(known[6:8]).lower(), ', '.join(known[8:]).lower())})
+		if self.rnd.random() < 0.1:
+			js['legendary_actions'] = [{'name': 'Detect', 'desc': 'The creature makes a Wisdom (Perception) check.'}, self.action('Tail Attack', 10)]
+		return js
+
+	def rst(self, js):
+		"""Return the tome of beasts rst stat block of the monster."""
+		bonus = lambda v: '%+d' % ((v-10)/2)
+		cells = ' | '.join('%-9s' % ('%s (%s)' % (js[a.lower()], bonus(js[a.lower()]))) for a, _ in abilities)
+		line = '+' + '+'.join(['-'*11]*6) + '+'
+		blocks = ['.. _tob:%s:' % js['name'].lower().replace(' ', '-'), '', js['name'], '-'*len(js['name']), '', 'Some lore text.', '',
+			js['name'], '~'*len(js['name']), '', '*%s %ss, %s*' % (js['size'], js['type'], js['alignment']), '',
+			'**Armor Class** %s (natural armor)' % js['armor_class'], '', '**Hit Points** %s (%s + 20)' % (js['hit_points'], js['hit_dice']), '',
+			'**Speed** %s' % js['speed'], '', line, '| ' + ' | '.join('%-9s' % a[:3].upper() for a, _ in abilities) + ' |',
+			line.replace('-', '='), '| ' + cells + ' |', line, '',
+			'**Senses** %s' % js['senses'], '', '**Languages** %s' % js['languages'], '', '**Challenge** %s (100 XP)' % js['challenge_rating'], '']
+		blocks += ['**%s**. %s' % (a['name'], a['desc'].replace('\n', ' ')) + '\n' for a in js['special_abilities']]
+		blocks += ['Actions', '~~~~~~~', '']
+		blocks += ['**%s**. %s' % (a['name'], a['desc']) + '\n' for a in js['actions']]
+		return u'\n'.join(blocks) + u'\n'
+
+	def png(self, fp, xy=(64, 64)):
+		color = tuple(self.rnd.randint(0, 255) for _ in range(3))
+		Image.new('RGB', xy, color).save(fp)
+
+	def generate(self):
+		"""Write the corpus, unless the same one is already there."""
+		stamp = self.path('corpus.json')
+		if os.path.exists(stamp):
+			with open(stamp, 'r') as sfile:
+				if json.load(sfile) == self.params: return self
+			shutil.rmtree(self.root)
+		log.warning('Generating %s' % self)
+		for d in ['5e-database', 'imglib', os.path.join('GUI_Icons_png', 'transparent'), self.rstDir, 'work']:
+			os.makedirs(self.path(d))
+		with open(self.path('5e-database', '5e-SRD-Ability-Scores.json'), 'w') as afile:
+			json.dump([{'full_name': a, 'skills': [{'name': s} for s in skills]} for a, skills in abilities], afile)
+		spells = sorted(set('%s %s' % (self.word(), self.word(1)) for _ in range(self.params['spells'])))
+		with open(self.path('5e-database', '5e-SRD-Spells.json'), 'w') as sfile:
+			json.dump([self.spell(name) for name in spells], sfile)
+		names = []
+		while len(names) < self.params['monsters']:
+			name = '%s %s' % (self.word(), self.rnd.choice(kinds))
+			if name not in names: names.append(name)
+		monsters = [self.monster(index, name, spells) for index, name in enumerate(names)]
+		nrst = int(len(monsters)*self.params['rst'])
+		for js in monsters[:nrst]:
+			with codecs.open(self.path(self.rstDir, js['name'].lower().replace(' ', '-')+'.rst'), 'w', encoding='utf8') as rfile:
+				rfile.write(self.rst(js))
+		with open(self.path('5e-database', '5e-SRD-Monsters.json'), 'w') as mfile:
+			json.dump(monsters[nrst:], mfile)
+		with open(self.path('5e-database', '5e-SRD-Monsters-volo.json'), 'w') as mfile:
+			json.dump([], mfile)
+		# half of the images are named after a monster, with some noise, the rest are unrelated
+		self.png(self.path('imglib', 'dft.png'))
+		for name in ['location', 'chest', 'gold', 'quest_complete', 'quest', 'magnifier']:
+			self.png(self.path('GUI_Icons_png', 'transparent', '%s_t.png' % name))
+		for index in range(self.params['images']):
+			if index % 2 == 0 and index/2 < len(names): name = self.rnd.choice(['%s', '%s 2', 'the %s', '%s-token']) % names[index/2]
+			else: name = '%s %s %s' % (self.word(), self.word(1), index)
+			self.png(self.path('imglib', name+'.png'))
+		for d in ['macros', 'templates']:
+			shutil.copytree(os.path.join(here, d), os.path.join(self.work, d))
+		with open(stamp, 'w') as sfile: json.dump(self.params, sfile)
+		return self
+
+	def rstFiles(self): return sorted(glob.glob(self.path(self.rstDir, '*.rst')))
+
+	def monsters(self):
+		with open(self.path('5e-database', '5e-SRD-Monsters.json'), 'r') as mfile: monsters = json.load(mfile)
+		for fp in self.rstFiles():
+			with codecs.open(fp, 'r', encoding='utf8') as rfile: monsters.append(loadFromRst(rfile))
+		return monsters
+
+	def spells(self):
+		with open(self.path('5e-database', '5e-SRD-Spells.json'), 'r') as sfile: return [Spell(js) for js in json.load(sfile)]
+
+def timed(fn, setup=lambda: None, repeat=3):
+	"""Return the best time of fn(setup()), setup is not timed."""
+	best = None
+	for _ in range(repeat):
+		data = setup()
+		start = timeit.default_timer()
+		fn(data)
+		elapsed = timeit.default_timer() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def run(corpus, repeat=3):
+	"""Benchmark the build stages on the corpus, return {stage: {'n': items, 'best': seconds}}."""
+	os.chdir(corpus.work)
+	# no persistent cache, every stage is measured cold
+	util.configureAssetCache('', 0)
+	tokens.args = argparse.Namespace(delivery=False, zip_only=False, thin=False)
+	tokens.imglib = corpus.path('imglib')
+	tokens.imglibs = [tokens.imglib]
+	Spell.spellDB = corpus.spells()
+	monsters = corpus.monsters()
+	rsts = corpus.rstFiles()
+	results = {}
+	def bench(stage, n, fn, setup=lambda: None):
+		results[stage] = {'n': n, 'best': timed(fn, setup, repeat)}
+		log.warning('%-18s %6d items %9.3f s %9.3f ms/item' % (stage, n, results[stage]['best'], results[stage]['best']*1000/max(n, 1)))
+
+	def parse(files):
+		for fp in files:
+			with codecs.open(fp, 'r', encoding='utf8') as rfile: loadFromRst(rfile)
+	bench('loadFromRst', len(rsts), lambda _: parse(rsts))
+	files = glob.glob(os.path.join(tokens.imglib, '*.png'))
+	bench('ImgIndex', len(files), lambda _: util.ImgIndex(files).match('x'))
+	Token.imgIndex = util.ImgIndex(files)
+
+	def fresh():
+		util.imgCache.clear()
+		return [Token(js) for js in monsters]
+	def warm():
+		toks = fresh()
+		for tok in toks: tok.assets, tok.macros
+		return toks
+	bench('Token.assets', len(monsters), lambda toks: [tok.assets for tok in toks], fresh)
+	bench('Token.macros', len(monsters), lambda toks: [tok.macros for tok in toks], fresh)
+	def cold():
+		toks = warm()
+		util.inlineTemplates.clear()
+		util.jenv().cache.clear()
+		return toks
+	bench('content_xml', len(monsters), lambda toks: [tok.content_xml for tok in toks], warm)
+	bench('content_xml.cold', len(monsters), lambda toks: [tok.content_xml for tok in toks], cold)
+	bench('Token.zipme', len(monsters), lambda toks: [tok.zipme() for tok in toks], warm)
+	toks = warm()
+	bench('Zone.build', len(toks), lambda zone: zone.build(toks), lambda: Zone('Library'))
+	def campaign():
+		zone = Zone('Library')
+		zone.build(toks)
+		cp = Campaign('bench')
+		cp.zones.append(zone)
+		cp.psets.append(PSet('Basic', []))
+		return cp
+	bench('Campaign.zipme', len(toks), lambda cp: cp.zipme(), campaign)
+	return results
+
+def compare(results, baseline):
+	"""Log the results relative to the baseline, return the stages slower by more than 10%."""
+	slower = []
+	for stage, res in sorted(results.iteritems()):
+		ref = baseline.get(stage)
+		if not ref: continue
+		ratio = res['best']/ref['best'] if ref['best'] else float('inf')
+		if ratio > 1.1: slower.append(stage)
+		log.warning('%-18s %9.3f s, baseline %9.3f s, x%.2f%s' % (stage, res['best'], ref['best'], ratio, ' SLOWER' if ratio > 1.1 else ''))
+	return slower
+
+def main():
+	parser = argparse.ArgumentParser(description='DnD 5e token builder benchmarks')
+	parser.add_argument('--monsters', '-m', type=int, default=100, help='number of synthetic monsters, 100 1000 10000')
+	parser.add_argument('--images', '-i', type=int, default=1000, help='number of synthetic images, 1000 20000')
+	parser.add_argument('--seed', type=int, default=5)
+	parser.add_argument('--repeat', '-r', type=int, default=3, help='keep the best of repeat runs')
+	parser.add_argument('--root', default=os.path.join(here, 'build', 'bench'), help='corpus and baseline directory')
+	parser.add_argument('--save', action="store_true", default=False, help='save the results as the new baseline')
+	args = parser.parse_args()
+	scale = '%s-%s-%s' % (args.monsters, args.images, args.seed)
+	corpus = Corpus(os.path.join(args.root, 'corpus-'+scale), args.monsters, args.images, args.seed).generate()
+	baselineFile = os.path.join(args.root, 'baseline-%s.json' % scale)
+	results = run(corpus, args.repeat)
+	if args.save:
+		with open(baselineFile, 'w') as bfile: json.dump(results, bfile, indent=1, sort_keys=True)
+		log.warning('Baseline saved in %s' % baselineFile)
+	elif os.path.exists(baselineFile):
+		with open(baselineFile, 'r') as bfile: slower = compare(results, json.load(bfile))
+		return 1 if slower else 0
+	else:
+		log.warning('No baseline in %s, run with --save to record one' % baselineFile)
+	return 0
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.WARNING)
+	raise SystemExit(main())
@@ -1,17 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import jinja2
 import zipfile
 import os
 import itertools
 import collections
 
-from util import jenv, getLogger
+from util import jenv, getLogger, templates, zipChunks, AssetRegistry, profiler
 
 log = getLogger(__name__)
 
 PSet = collections.namedtuple('PSet', ['name', 'props'])
 
+templates['cprop.template'] = '''            <net.rptools.maptool.model.TokenProperty>
+              <name>{{prop.name}}</name>
+	      {% if prop.shortname %}
+	      <shortName>{{prop.shortname}}</shortName>}
+	      {% endif -%}
+              <highPriority>{{prop.showOnSheet}}</highPriority>
+              <ownerOnly>{{ownerOnly}}</ownerOnly>
+              <gmOnly>{{prop.gmOnly}}</gmOnly>
+              <defaultValue>{{prop.defaultValue}}</defaultValue>
+            </net.rptools.maptool.model.TokenProperty>'''
+
 class Campaign(object):
 	def __init__(self, name):
 		self.name = name
@@ -27,8 +37,10 @@ class Campaign(object):
 
 	@property
 	def assets(self):
-		for elem in  itertools.chain(self.tokens, self.tables):
-			for k,v in elem.assets.iteritems(): yield k,v
+		assets = AssetRegistry()
+		for zone in self.zones: assets.update(zone.assets)
+		assets.update((asset.name, asset) for table in self.tables for asset in table.assets.itervalues())
+		return assets
 
 	def __repr__(self): return 'Cmpgn<%s,%s prop_sets, %s tokens>' % (self.name, len(self.psets), len(list(self.tokens)))
 
@@ -36,6 +48,11 @@ class Campaign(object):
 	def content_xml(self):
 		return jenv().get_template('cmpgn_content.template').render(cmpgn=self) or u''
 
+	def content_chunks(self):
+		"""Generate the content xml as utf-8 chunks, zones and tokens are rendered as they come."""
+		for chunk in jenv().get_template('cmpgn_content.template').generate(cmpgn=self):
+			yield chunk.encode('utf-8')
+
 	@property
 	def properties_xml(self):
 		return jenv().get_template('cmpgn_properties.template').render(cmpgn=self) or u''
@@ -44,17 +61,12 @@ class Campaign(object):
 		"""Zip the Campaing into a cmpgn file."""
 		log.info("Zipping %s" % self)
 		if not os.path.exists('build'): os.makedirs('build')
-		with zipfile.ZipFile(os.path.join('build', '%s.cmpgn'%self.name), 'w') as zipme:
-			zipme.writestr('content.xml', self.content_xml.encode('utf-8'))
+		with profiler.stage('Campaign.zipme'), zipfile.ZipFile(os.path.join('build', '%s.cmpgn'%self.name), 'w') as zipme:
+			zipChunks(zipme, 'content.xml', self.content_chunks())
 			zipme.writestr('properties.xml', self.properties_xml.encode('utf-8'))
-			md5s = [] # record added assets
-			for name, asset in self.assets:
-				if asset.md5 in md5s: continue # dont zip the same file twice
-				log.debug("adding asset %s: %s" % (name, asset))
-				md5s.append(asset.md5)
-				zipme.writestr('assets/%s' % asset.md5,
-					jenv().get_template('md5.template').render(name=os.path.splitext(os.path.basename(asset.fp))[0], extension='png', md5=asset.md5).encode('utf-8'))
-				zipme.writestr('assets/%s.png' % asset.md5, asset.bytes)
+			assets = self.assets # dont zip the same file twice
+			log.info("adding %s" % assets)
+			assets.zipme(zipme)
 
 	def build(self, zones, psets, tables):
 		"""Build a campaign given the tokens, properties all json data."""
@@ -75,15 +87,4 @@ class CProp(object):
 	@classmethod
 	def fromTProp(cls, token_prop): return cls({"name": token_prop.name})
 	def __repr__(self): return '%s<%s>' % (self.__class__.__name__, self.name)
-	def render(self):
-		return jinja2.Template('''            <net.rptools.maptool.model.TokenProperty>
-              <name>{{prop.name}}</name>
-	      {% if prop.shortname %}
-	      <shortName>{{prop.shortname}}</shortName>}
-	      {% endif -%}
-              <highPriority>{{prop.showOnSheet}}</highPriority>
-              <ownerOnly>{{ownerOnly}}</ownerOnly>
-              <gmOnly>{{prop.gmOnly}}</gmOnly>
-              <defaultValue>{{prop.defaultValue}}</defaultValue>
-            </net.rptools.maptool.model.TokenProperty>''').render(prop=self)
-
+	def render(self): return jenv().get_template('cprop.template').render(prop=self)
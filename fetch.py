@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import json
+import urlparse
+import threading
+import requests
+from multiprocessing.pool import ThreadPool
+
+from util import getLogger
+
+log = getLogger(__name__)
+
+class Fetcher(object):
+	"""Fetch the dnd5 api json with a pooled session and a bounded number of threads.
+
+	Requests failing on a connection error or a 429/5xx status are retried with
+	an exponential backoff. Given a Store, responses are cached and revalidated
+	with ETag / If-Modified-Since."""
+	retryStatus = (429, 500, 502, 503, 504)
+	def __init__(self, base, jobs=8, retries=3, backoff=0.5, timeout=30, store=None):
+		self.base = base
+		self.jobs = jobs
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.store = store
+		self.lock = threading.Lock() # guards the store and the counters
+		self.requests, self.notModified = 0, 0
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	def __repr__(self): return 'Fetcher<%s,requests=%s,not modified=%s>' % (self.base, self.requests, self.notModified)
+
+	def _request(self, url, headers):
+		for attempt in range(self.retries+1):
+			if attempt: time.sleep(self.backoff*2**(attempt-1))
+			try:
+				response = self.session.get(url, headers=headers, timeout=self.timeout)
+			except (requests.ConnectionError, requests.Timeout), e:
+				if attempt == self.retries: raise
+				log.warning("%s: %s, retrying" % (url, e))
+				continue
+			if response.status_code not in self.retryStatus or attempt == self.retries: return response
+			log.warning("%s: status %s, retrying" % (url, response.status_code))
+
+	def get(self, url):
+		"""Return the json data at url, relative to the base url."""
+		url = urlparse.urljoin(self.base, url)
+		cached = None
+		if self.store:
+			with self.lock: cached = self.store.response(url)
+		headers = {}
+		if cached:
+			etag, modified, body = cached
+			if etag: headers['If-None-Match'] = etag
+			if modified: headers['If-Modified-Since'] = modified
+		response = self._request(url, headers)
+		with self.lock:
+			self.requests += 1
+			if response.status_code == 304:
+				self.notModified += 1
+				return json.loads(body)
+			response.raise_for_status()
+			if self.store: self.store.putResponse(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.text)
+		return response.json()
+
+	def fetchAll(self, category):
+		"""Yield every item of the category, in the api listing order."""
+		listing = self.get(category+'/')
+		log.info("Found %s %s" % (listing['count'], category))
+		pool = ThreadPool(self.jobs)
+		try:
+			for item in pool.imap(self.get, [item['url'] for item in listing['results']]):
+				log.info("fetched %s" % item['name'])
+				yield item
+		finally:
+			pool.terminate()
+			pool.join()
+			log.info(self)
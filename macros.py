@@ -2,12 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import jinja2
 import re
+import collections
+
+from util import jenv, inlineTemplate, templates
 
 log = logging.getLogger(__name__)
 
-spellTemplate = u'''
+# stat block patterns, like "+4 to hit, reach 5 ft., one target. Hit: 7 (1d10 + 2) piercing damage."
+hitPattern = re.compile(r'\+(\d+) to hit,.*\((\d+d\d+) \+ (\d+)\) (\w+) damage')
+reachPattern = re.compile(r'reach (\d+) ?ft\.')
+# the extra damage of a hit, like "Hit: 11 (2d6 + 4) piercing damage plus 7 (2d6) fire damage."
+secondaryPattern = re.compile(r'plus \d+ \((\d+d\d+)(?: \+ \d+)?\) (\w+) damage')
+
+Attack = collections.namedtuple('Attack', ['attack_bonus', 'damage_dice', 'damage_bonus', 'damage_type', 'reach', 'secondary_dice', 'secondary_type'])
+
+def parseAttack(action):
+	"""Parse the action stat block into an Attack, the action fields left to their default are infered from the description."""
+	desc = action.get('desc', "")
+	hit = hitPattern.search(desc)
+	ab, dd, db, dt = action.get('attack_bonus', 0), action.get('damage_dice', ""), action.get('damage_bonus', 0), action.get('damage_type', "")
+	if hit:
+		if ab == 0: ab = hit.group(1)
+		if dd == "": dd = hit.group(2)
+		if db == 0: db = hit.group(3)
+		if dt == "": dt = hit.group(4)
+	reach = action.get('reach', 0)
+	if reach == 0:
+		match = reachPattern.search(desc)
+		if match: reach = int(match.group(1))
+	# searched after the hit, the greedy hit pattern matches the last '(XdY + Z) type damage'
+	secondary = secondaryPattern.search(desc, hit.end() if hit else 0)
+	sd, st = secondary.groups() if secondary else ("", "")
+	return Attack(ab, dd, db, dt, reach, sd, st)
+
+templates['spell_macro.template'] = u'''
 [h:data = json.set("{}",
 	"Flavor", "{{token.name}} casts {{spell.name}}",
 	"ParentToken",currentToken(),
@@ -51,7 +80,10 @@ class Macro(object):
 	def verbose(self): return "\t%s\n" % self
 
 	@property
-	def command(self): return jinja2.Template(self._command).render(macro=self)
+	def template(self): return inlineTemplate(self._command)
+
+	@property
+	def command(self): return self.template.render(macro=self)
 
 	@property
 	def label(self): return self._label
@@ -104,6 +136,7 @@ class DescrMacro(Macro):
 class ActionMacro(DescrMacro) :
 	def __init__(self, token, action):
 		self.action = action
+		self.stats = parseAttack(action)
 		label = action['name']
 		if self.damage_dice:
 			label += ' +%s %s+%s'%( self.attack_bonus, self.damage_dice, self.damage_bonus)
@@ -121,7 +154,7 @@ class ActionMacro(DescrMacro) :
 	"FlavorText","%s attacks!",
 	"ButtonColor","green",
 	"FontColor","white")]
-[macro("NPCAttack@Lib:Addon5e"):jsonWeaponData]'''%(label, self.damage_dice, self.damage_bonus, self.damage_type, self.attack_bonus, 
+[macro("NPCAttack@Lib:Addon5e"):jsonWeaponData]'''%(label, self.damage_dice, self.damage_bonus, self.damage_type, self.attack_bonus,
 	action['desc'].encode('ascii', 'xmlcharrefreplace'), token.name))
 		else:
 			DescrMacro.__init__(self, token, action)
@@ -129,55 +162,30 @@ class ActionMacro(DescrMacro) :
 	def verbose(self):
 		v = "\t%s\n" % self
 		if self.desc: v+= "\t\t%s\n" % self.desc
-		for field in ['attack_bonus', 'damage_dice', 'damage_bonus', 'damage_type', 'reach']:
-			if getattr(self, field) : v += "\t\t%s: %s\n" % (field, getattr(self, field))
+		for field, value in self.stats._asdict().iteritems():
+			if value : v += "\t\t%s: %s\n" % (field, value)
 		return v
 
 	@property
-	def hit_dd_db_type(self):
-		match = re.search(r'\+(\d+) to hit,.*\((\d+d\d+) \+ (\d+)\) (\w+) damage', self.desc)
-		return match.groups() if match else None
+	def damage_dice(self): return self.stats.damage_dice
 
+	@property
+	def damage_bonus(self): return self.stats.damage_bonus
 
 	@property
-	def damage_dice(self):
-		dd = self.action.get('damage_dice', "")
-		# try infering the damage dice from the description
-		if dd == "" and self.hit_dd_db_type is not None:
-			dd = self.hit_dd_db_type[1]
-		return dd
+	def damage_type(self): return self.stats.damage_type
 
 	@property
-	def damage_bonus(self):
-		db = self.action.get('damage_bonus', 0)
-		# try infering the damage dice from the description
-		if db == 0 and self.hit_dd_db_type is not None:
-			db = self.hit_dd_db_type[2]
-		return db
+	def attack_bonus(self): return self.stats.attack_bonus
 
 	@property
-	def damage_type(self):
-		dt = self.action.get('damage_type', "")
-		# try infering the damage dice from the description
-		if dt == "" and self.hit_dd_db_type is not None:
-			dt = self.hit_dd_db_type[3]
-		return dt
+	def reach(self): return self.stats.reach
 
 	@property
-	def attack_bonus(self):
-		ab = self.action.get('attack_bonus', 0)
-		# try infering the damage dice from the description
-		if ab == 0 and self.hit_dd_db_type is not None:
-			ab = self.hit_dd_db_type[0]
-		return ab
+	def secondary_dice(self): return self.stats.secondary_dice
 
 	@property
-	def reach(self):
-		reach = self.action.get('reach', 0)
-		if reach == 0 :
-			match = re.search(r'reach (\d+) ?ft\.', self.desc)
-			if match: reach = int(match.group(1))
-		return reach
+	def secondary_type(self): return self.stats.secondary_type
 
 	@property
 	def group(self): return self._group or 'Action'
@@ -232,7 +240,7 @@ class SpellMacro(Macro):
 		suffix += 'R' if 'reaction' in spell.casting_time else ''
 		suffix += (('c' if suffix=='(' else ',c') if spell.concentration else '')
 		suffix += ')'
-		Macro.__init__(self, token, spell.js, spell.name+(suffix if suffix!='()' else ''), jinja2.Template(spellTemplate).render(spell=spell, token=token))
+		Macro.__init__(self, token, dict(spell.js), spell.name+(suffix if suffix!='()' else ''), jenv().get_template('spell_macro.template').render(spell=spell, token=token))
 		self.action['description'] = '\n'.join(self.action['desc'])
 		self._group = 'Level %s' % spell.level if spell.level >= 1 else 'Cantrips'
 
@@ -243,7 +251,11 @@ class SpellMacro(Macro):
 
 
 class SheetMacro(Macro):
-	def __init__(self, token):
-		with open('macros/token_sheet.mtmacro') as template:
-			Macro.__init__(self, token, None, 'Sheet', template.read(), **{'group':"Sheet", 'colors': ('black', 'yellow'), 'tooltip': 'Display the NPC sheet'})
+	"""The NPC sheet, a thin sheet reads everything from the token properties and is shared on the Lib token."""
+	def __init__(self, token, thin=False):
+		Macro.__init__(self, token, None, 'Sheet', None, **{'group':"Sheet", 'colors': ('black', 'yellow'), 'tooltip': 'Display the NPC sheet'})
+		self.thin = thin
+
+	@property
+	def template(self): return jenv().get_template('token_sheet.mtmacro')
 
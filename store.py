@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sqlite3
+import hashlib
+import json
+
+from util import getLogger
+
+log = getLogger(__name__)
+
+class Store(object):
+	"""A sqlite store of the dnd5 api items, one row per item keyed by category, source and name.
+
+	The source is the item 'ref' (Tome of Beasts, ...), empty for the SRD, or
+	the one given to put. Rows are rewritten only when the md5 of their json
+	data changed. A store
+	with an other schema version is dropped and recreated. The api responses
+	are also kept, for conditional requests."""
+	schema = 3
+	def __init__(self, fp):
+		self.fp = fp
+		self.db = sqlite3.connect(fp, check_same_thread=False) # the Fetcher threads use a lock
+		version = self.db.execute('PRAGMA user_version').fetchone()[0]
+		if version != self.schema:
+			if version: log.warning("%s schema version %s, expecting %s, dropping it" % (fp, version, self.schema))
+			with self.db:
+				self.db.execute('DROP TABLE IF EXISTS items')
+				self.db.execute('DROP TABLE IF EXISTS responses')
+				self.db.execute('CREATE TABLE items (category TEXT, source TEXT, name TEXT, md5 TEXT, js TEXT, PRIMARY KEY (category, source, name))')
+				self.db.execute('CREATE TABLE responses (url TEXT PRIMARY KEY, etag TEXT, modified TEXT, body TEXT)')
+				self.db.execute('PRAGMA user_version = %d' % self.schema)
+
+	def __repr__(self): return 'Store<%s>' % self.fp
+	def __enter__(self): return self
+	def __exit__(self, *exc): self.close()
+	def close(self): self.db.close()
+
+	@staticmethod
+	def source(js): return js.get('ref') or ''
+
+	def _where(self, category, source=None):
+		if source is None: return 'category=?', (category,)
+		return 'category=? AND source=?', (category, source)
+
+	def count(self, category, source=None):
+		where, params = self._where(category, source)
+		return self.db.execute('SELECT COUNT(*) FROM items WHERE %s' % where, params).fetchone()[0]
+
+	def names(self, category, source=None):
+		where, params = self._where(category, source)
+		return [name for name, in self.db.execute('SELECT name FROM items WHERE %s ORDER BY rowid' % where, params)]
+
+	def get(self, category, name, source=None):
+		"""Return the json data of the item, the first stored one if no source is given, None if not found."""
+		where, params = self._where(category, source)
+		row = self.db.execute('SELECT js FROM items WHERE %s AND name=? ORDER BY rowid' % where, params + (name,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def load(self, category, names=None, source=None):
+		"""Yield the json data of all the category items, or only the named ones."""
+		if names is None:
+			where, params = self._where(category, source)
+			for js, in self.db.execute('SELECT js FROM items WHERE %s ORDER BY rowid' % where, params): yield json.loads(js)
+			return
+		for name in names:
+			js = self.get(category, name, source)
+			if js is not None: yield js
+
+	def put(self, category, items, source=None, prune=False):
+		"""Insert or update the items json data, return the number of rows written.
+
+		The items source is the given one, or their own. With prune, the rows of
+		the written sources that are not in items are deleted, items must then be
+		the complete list of these sources."""
+		written, seen = 0, {}
+		if source is not None: seen[source] = set()
+		with self.db:
+			for js in items:
+				src = self.source(js) if source is None else source
+				seen.setdefault(src, set()).add(js['name'])
+				data = json.dumps(js, sort_keys=True)
+				md5 = hashlib.md5(data).hexdigest()
+				key = (category, src, js['name'])
+				row = self.db.execute('SELECT md5 FROM items WHERE category=? AND source=? AND name=?', key).fetchone()
+				if row and row[0] == md5: continue
+				if row: self.db.execute('UPDATE items SET md5=?, js=? WHERE category=? AND source=? AND name=?', (md5, data) + key)
+				else: self.db.execute('INSERT INTO items (category, source, name, md5, js) VALUES (?, ?, ?, ?, ?)', key + (md5, data))
+				written += 1
+			pruned = 0
+			for src, names in (seen.items() if prune else []):
+				for name in set(self.names(category, src)) - names:
+					self.db.execute('DELETE FROM items WHERE category=? AND source=? AND name=?', (category, src, name))
+					pruned += 1
+		log.info("%s: %s %s written, %s pruned" % (self, written, category, pruned))
+		return written
+
+	def response(self, url):
+		"""Return the cached (etag, last modified, body) of the url, None if not cached."""
+		return self.db.execute('SELECT etag, modified, body FROM responses WHERE url=?', (url,)).fetchone()
+
+	def putResponse(self, url, etag, modified, body):
+		if not etag and not modified: return # cannot be revalidated
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO responses (url, etag, modified, body) VALUES (?, ?, ?, ?)', (url, etag, modified, body))
@@ -9,11 +9,15 @@ HTML_COMMENT
 OPEN
 	: '[' -> pushMode(MT)
 	;
+// {expr}, an inline roll
+OPEN_INLINE
+	: '{' -> pushMode(MT)
+	;
 CB
 	: '}' ->popMode
 	;
 TEXT
-	: ~('['|'}')+?
+	: ~('['|'{'|'}')+?
 	;
 
 mode MT ;
@@ -22,21 +26,24 @@ ADD: '+';
 MUL: '*';
 DIV: '/';
 SUB: '-';
-IF: 'if';
-COUNT: 'count';
 SEMI_COLON: ';';
 COLON: ':';
 COMMA: ',';
 OP: '(';
 CP: ')';
 OB: '{' -> pushMode(DEFAULT_MODE);
+CLOSE_INLINE: '}' -> popMode;
 ROLL: [1-9]* [0-9] [dD] [1-9]* [0-9]+;
 NAME: [a-zA-Z_.] [a-zA-Z0-9_.]* ;
 EQUAL : '=';
-COMP_OP : ('==' | '<' | '>');
+COMP_OP : ('==' | '!=' | '<=' | '>=' | '<' | '>');
+AND: '&&';
+OR: '||';
+NOT: '!';
 NUMBER : [0-9]+;
-STRING : ( '\''     ('\\' (([ \t]+ ('\r'? '\n')?)|.) | ~[\\\r\n'])*  '\''
-		| '"'      ('\\' (([ \t]+ ('\r'? '\n')?)|.) | ~[\\\r\n"])*  '"'
+// a string may span several lines, the evalMacro('...') html
+STRING : ( '\''     ('\\' . | ~[\\'])*  '\''
+		| '"'      ('\\' . | ~[\\"])*  '"'
 		)
 		;
 WS : [ \t\r\n]+ -> skip ; // skip spaces, tabs, newlines
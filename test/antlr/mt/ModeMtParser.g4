@@ -4,24 +4,36 @@ options {tokenVocab=ModeMtLexer;}
 
 // default mode is raw html
 
-entry: mtfile;
-// a MT file is a collection of MT blocks or html
-mtfile: (('[' block ']') | html)*;
+entry: mtfile EOF;
+// a MT file is a collection of MT blocks, inline rolls or html
+mtfile: ((OPEN block CLOSE) | inline | html)*;
+inline: OPEN_INLINE stat_expr CLOSE_INLINE;
 
-// a MT block embbed MT code
-block: stat_expr | (NAME ':' stat_expr) | ((NAME ',')? (if_option | count_option));
+// a MT block embbed MT code, after its roll options: h, r, if(test), count(n),
+// foreach(var, list), switch(value), macro(name), frame(name), code...
+// the option names and their arguments are checked by the mt module
+block: (options ':')? body;
+options: option (',' option)*;
+option: NAME ('(' exprlist? ')')?;
+// a code block or a statement, each with its else branch, or the switch cases
+body: code (';' code)?
+	| switch_case (';' switch_case)* ';'?
+	| stat_expr (';' stat_expr)?;
+code: OB mtfile CB;
+// case "value": {...} or default: {...}
+switch_case: NAME (STRING | NUMBER)? ':' (code | stat_expr);
 
 // statement or expression
 stat_expr: assign | expr;
 
 assign : NAME EQUAL expr ;
-if_option : 'if' '(' test ')' ':' stat_expr ';' stat_expr;
-count_option : 'count' '(' expr ')' ':' stat_expr ;
-test: (expr | comparison);
-comparison: expr COMP_OP expr;
 expr:
-	expr ( MUL|DIV) expr
+	(SUB|NOT) expr
+	| expr (MUL|DIV) expr
 	| expr (ADD|SUB) expr
+	| expr COMP_OP expr
+	| expr AND expr
+	| expr OR expr
 	| call
 	| ROLL | NUMBER | NAME | STRING
 	| '(' expr ')';
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fuzz the parser and the compiler with random mutations of the macros/ library.
+#
+#   python fuzz.py                        # 10000 mutations of ../../../macros/*.mtmacro
+#   python fuzz.py --runs 1000 sample1.mtmacro
+#
+# A mutated macro may be rejected by the parser (MtSyntaxError) or fail when run
+# (ParseError, a python error on the operands), anything else is a bug.
+
+import os
+import sys
+import glob
+import time
+import random
+import itertools
+import argparse
+import traceback
+
+import mt
+
+here = os.path.dirname(os.path.abspath(__file__))
+library = os.path.join(here, '..', '..', '..', 'macros')
+
+# the characters that matter to the grammar, and some that don't
+alphabet = '[]{}();:,=+-*/<>"\'%d 0123456789abcxyz\n\t'
+# the errors a macro may raise when run, bad operands or unknown symbols
+runErrors = (mt.ParseError, TypeError, ValueError, ZeroDivisionError, OverflowError)
+# a binding for the names of the library macros, an arbitrary value is enough
+# and a roll that does not take forever on 444444d6
+bindings = {'getProperty': lambda *a: 1, 'json.get': lambda *a: 1, 'arg': lambda a: a, 'argCount': lambda: 0, 'roll': lambda n, d: n}
+
+def mutate(source, rnd, edits=3):
+	"""Return the source with a few random char insertions, deletions and duplications."""
+	chars = list(source)
+	for _ in xrange(rnd.randint(1, edits)):
+		pos = rnd.randint(0, len(chars))
+		kind = rnd.random()
+		if kind < 0.4 or not chars: chars.insert(pos, rnd.choice(alphabet))
+		elif kind < 0.8: del chars[min(pos, len(chars)-1)]
+		else:
+			end = min(len(chars), pos+rnd.randint(1, 20))
+			chars[pos:pos] = chars[pos:end]
+	return ''.join(chars)
+
+def check(source):
+	"""Parse, compile and run the source, return its outcome: 'rejected', 'failed' or 'ran'.
+
+	Raise an AssertionError describing the bug for any other exception."""
+	try:
+		macro = mt.MtMacro(source)
+	except mt.MtSyntaxError: return 'rejected'
+	except Exception:
+		raise AssertionError("compiling %r\n%s" % (source, traceback.format_exc()))
+	try:
+		output, memory = macro(dict(bindings))
+	except runErrors: return 'failed'
+	except Exception:
+		raise AssertionError("running %r\n%s" % (source, traceback.format_exc()))
+	if not isinstance(output, basestring): raise AssertionError("running %r returned %r" % (source, output))
+	return 'ran'
+
+def fuzz(sources, runs, seed=0):
+	"""Check runs mutations of the sources, return the outcome counts and the bugs."""
+	rnd = random.Random(seed)
+	counts, bugs = {'rejected': 0, 'failed': 0, 'ran': 0}, []
+	# the originals, then their mutations
+	mutations = (mutate(rnd.choice(sources), rnd) for _ in xrange(runs))
+	for source in itertools.chain(sources, mutations):
+		try:
+			counts[check(source)] += 1
+		except AssertionError, e:
+			bugs.append(str(e))
+	return counts, bugs
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='fuzz the MTScript parser and compiler')
+	parser.add_argument('files', nargs='*', help='macro files, the macros/ library by default')
+	parser.add_argument('--runs', '-r', type=int, default=10000)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+	files = args.files or sorted(glob.glob(os.path.join(library, '*.mtmacro')))
+	sources = []
+	for fp in files:
+		with open(fp, 'r') as mfile: sources.append(mfile.read().decode('utf-8'))
+	start = time.time()
+	counts, bugs = fuzz(sources, args.runs, args.seed)
+	elapsed = time.time() - start
+	for bug in bugs[:10]: print bug
+	print "%s files, %s mutations, %d/s: %s, %s bugs" % (len(files), args.runs, args.runs/elapsed if elapsed else 0, counts, len(bugs))
+	return 1 if bugs else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,96 +1,345 @@
 import sys
-import ast
-import antlr4 as a4
 import re
-from ModeMtLexer import ModeMtLexer
-from ModeMtParser import ModeMtParser
-from ModeMtParserVisitor import ModeMtParserVisitor
+import time
+import random
+import hashlib
+import operator
+import json
+from mtparse import MtLexer, MtParser, MtParserVisitor, TerminalNode
+try:
+	# the antlr runtime, only needed by parseAntlr
+	from antlr4.tree.Tree import TerminalNode as AntlrTerminalNode
+	from antlr4.error.ErrorListener import ErrorListener
+	terminals = (TerminalNode, AntlrTerminalNode)
+except ImportError:
+	ErrorListener, terminals = object, (TerminalNode,)
 
 class ParseError(Exception): pass
 
+class MtSyntaxError(ParseError):
+	def __init__(self, line, column, msg):
+		ParseError.__init__(self, "line %s:%s %s" % (line, column, msg))
+		self.line, self.column, self.msg = line, column, msg
+
+class RaisingErrorListener(ErrorListener):
+	"""Fail on the first syntax error instead of reporting it on stderr and recovering."""
+	def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+		raise MtSyntaxError(line, column, msg)
+
 def listAppend(*args): return args
 
-class MtVisitor(ModeMtParserVisitor):
-	def __init__(self, *args, **kwargs):
-		ModeMtParserVisitor.__init__(self, *args, **kwargs)
-		self.memory = {'arg': (lambda a: "p%s"%a), 'listAppend': listAppend, 'roll': (lambda n, d: '%sd%s'%(n,d)), 'eval': lambda x:x, 'strformat': lambda x:x}
-		self.out = ""
-	def _visitAll(self, ctxlist):
-		out = ""
-		for c in ctxlist:
-			ret = self.visit(c)
-			if ret is not None: out += str(ret)
-		return out
+# the compiled macros functions, a macro can rebind them
+builtins = {
+	'arg': (lambda a: "p%s"%a),
+	'listAppend': listAppend,
+	'roll': (lambda n, d: sum(random.randint(1, d) for _ in xrange(n))),
+	'eval': lambda x:x,
+	'strformat': lambda x:x,
+}
+
+# the roll options => their (min, max) arguments, the names are case insensitive
+rollOptions = {
+	'h': (0, 0), 'hidden': (0, 0), 'r': (0, 0), 'result': (0, 0), 'e': (0, 0), 'expanded': (0, 0),
+	'u': (0, 0), 'unformatted': (0, 0), 'g': (0, 0), 'gm': (0, 0), 's': (0, 0), 'self': (0, 0), 'gt': (0, 0), 'st': (0, 0),
+	't': (0, 1), 'tooltip': (0, 1), 'w': (1, 1), 'whisper': (1, 1),
+	'count': (1, 2), 'for': (3, 5), 'foreach': (2, 4), 'while': (1, 2),
+	'if': (1, 1), 'switch': (1, 1), 'code': (0, 0), 'macro': (1, 1), 'token': (1, 1), 'frame': (1, 2), 'dialog': (1, 2),
+}
+aliases = {'hidden': 'h', 'result': 'r', 'expanded': 'e', 'unformatted': 'u', 'self': 's', 'tooltip': 't', 'whisper': 'w'}
+
+def optionName(option): return option.NAME().getText().lower()
+
+class OptionChecker(MtParserVisitor):
+	"""Check the roll options of the blocks and that they match the block body."""
+	def visitBlock(self, ctx):
+		names = set()
+		for option in ctx.options().option() if ctx.options() else []:
+			token, name = option.NAME().getSymbol(), optionName(option)
+			count = len(option.exprlist().expr()) if option.exprlist() else 0
+			if name not in rollOptions: self.fail(token, "unknown roll option '%s'" % token.text)
+			low, high = rollOptions[name]
+			if not low <= count <= high:
+				self.fail(token, "roll option '%s' takes %s arguments, not %s" % (token.text, low if low == high else '%s to %s' % (low, high), count))
+			if name in ('for', 'foreach') and option.exprlist().expr(0).NAME() is None: self.fail(token, "roll option '%s' needs a variable name" % token.text)
+			names.add(aliases.get(name, name))
+		body = ctx.body()
+		if body.code() and not names & set(['code', 'frame', 'dialog']): self.fail(body.start, "code block without the code, frame or dialog option")
+		if len(body.code() or body.stat_expr()) > 1 and 'if' not in names: self.fail(body.SEMI_COLON(0).getSymbol(), "else branch without the if option")
+		if body.switch_case() and 'switch' not in names: self.fail(body.start, "case without the switch option")
+		if 'switch' in names and not body.switch_case(): self.fail(body.start, "switch option without case")
+		for case in body.switch_case():
+			name = case.NAME().getText()
+			if (name, (case.STRING() or case.NUMBER()) is not None) not in [('case', True), ('default', False)]:
+				self.fail(case.start, "expecting case \"value\": or default:")
+		return self.visitChildren(ctx)
+
+	def fail(self, token, msg): raise MtSyntaxError(token.line, token.column, msg)
+
+def parse(source):
+	"""Return the entry parse tree of the macro source, raise MtSyntaxError if it's malformed."""
+	lexer = MtLexer(source)
+	lexer.removeErrorListeners()
+	lexer.addErrorListener(RaisingErrorListener())
+	parser = MtParser(lexer)
+	parser.removeErrorListeners()
+	parser.addErrorListener(RaisingErrorListener())
+	tree = parser.entry()
+	OptionChecker().visit(tree)
+	return tree
+
+def parseAntlr(source):
+	"""Same as parse, with the parser antlr generates from the grammar (see mtparse)."""
+	import antlr4 as a4
+	from ModeMtLexer import ModeMtLexer
+	from ModeMtParser import ModeMtParser
+	lexer = ModeMtLexer(a4.InputStream(source))
+	lexer.removeErrorListeners()
+	lexer.addErrorListener(RaisingErrorListener())
+	parser = ModeMtParser(a4.CommonTokenStream(lexer))
+	parser.removeErrorListeners()
+	parser.addErrorListener(RaisingErrorListener())
+	tree = parser.entry()
+	OptionChecker().visit(tree)
+	return tree
+
+class Const(object):
+	"""A compiled constant, folded at compile time."""
+	def __init__(self, value): self.value = value
+	def __call__(self, mem): return self.value
+
+def truth(value):
+	if isinstance(value, basestring): return value.strip().lower() not in ('', '0', 'false')
+	return bool(value)
+
+def add(left, right):
+	# MTScript concatenates a string with anything
+	if isinstance(left, basestring) or isinstance(right, basestring): return u'%s%s' % (left, right)
+	return left + right
+
+def items(value, separator=','):
+	"""The foreach items of a json array or object, or of a string list."""
+	if isinstance(value, basestring) and value.strip()[:1] in ('[', '{'):
+		try: value = json.loads(value)
+		except ValueError: pass
+	if isinstance(value, dict): return value.keys()
+	if isinstance(value, (list, tuple)): return value
+	return [item.strip() for item in unicode(value).split(separator) if item.strip()]
+
+class MtCompiler(MtParserVisitor):
+	"""Compile the parse tree once into python closures taking the macro memory.
+
+	Strings lose their quotes, tests are not evaluated as python code and dice
+	are rolled. The output of a frame or dialog block goes in the memory, under
+	(kind, name), instead of the macro output."""
+	comparisons = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '>': operator.gt, '<=': operator.le, '>=': operator.ge}
+	arithmetic = {'+': add, '-': operator.sub, '*': operator.mul, '/': operator.div}
+	# the loop options, the index of their separator argument
+	loops = {'count': 1, 'for': 4, 'foreach': 2, 'while': 1}
+	# a loop runs at most maxLoops times, the same limit as the mutated count(444444)
+	maxLoops = 10000
+
+	def visitEntry(self, ctx): return self.visit(ctx.mtfile())
+
 	def visitMtfile(self, ctx):
-		self.output = self._visitAll(ctx.children)
-	def visitHtml(self, ctx):
-		return ctx.TEXT().getText()
+		parts = []
+		for c in ctx.children or []:
+			if isinstance(c, terminals): continue
+			part = self.visit(c)
+			# merge the consecutive html
+			if parts and isinstance(part, Const) and isinstance(parts[-1], Const):
+				parts[-1] = Const(u'%s%s' % (parts[-1].value, part.value))
+			else: parts.append(part)
+		if not parts: return Const(u'')
+		if len(parts) == 1 and isinstance(parts[0], Const): return Const(unicode(parts[0].value))
+		def mtfile(mem):
+			out = []
+			for part in parts:
+				ret = part(mem)
+				if ret is not None: out.append(unicode(ret))
+			return u''.join(out)
+		return mtfile
+
+	def visitHtml(self, ctx): return Const(ctx.TEXT().getText())
+
+	def visitInline(self, ctx): return self.visit(ctx.stat_expr())
+
+	def visitCode(self, ctx): return self.visit(ctx.mtfile())
+
 	def visitBlock(self, ctx):
-		print "Visiting a MT block %s, children: %s" % (ctx.getText(), [c.getText() for c in ctx.children])
-		ro = ctx.NAME().getText() if ctx.NAME() else ""
-		out = self._visitAll(ctx.children)
-		return out if 'h' != ro else ''
-
-	def visitIf_option(self, ctx):
-		# note in the parent ctx we may fetch the display option
-		test = eval(str(self.visit(ctx.test())))
-		if (test): return self.visit(ctx.stat_expr(0))
-		if (not test): return self.visit(ctx.stat_expr(1))
-	def visitTest(self, ctx):
-		if len(ctx.children) > 1: raise ParseError("Invalid test %s " % ctx.getText())
-		foo =  self.visit(ctx.children[0])
-		return foo
-	def visitComparison(self, ctx):
-		evalMe = "%s %s %s" % (self.visit(ctx.expr(0)), ctx.COMP_OP().getText(), self.visit(ctx.expr(1)))
-		ret = eval(evalMe)
-		return ret
+		options = {} # option => its compiled arguments
+		for option in ctx.options().option() if ctx.options() else []:
+			name = optionName(option)
+			options[aliases.get(name, name)] = [self.visit(e) for e in option.exprlist().expr()] if option.exprlist() else []
+		body = ctx.body()
+		if body.switch_case(): run = self.switch(options['switch'][0], body.switch_case())
+		else:
+			branches = [self.visit(c) for c in body.code() or body.stat_expr()]
+			run = self.branch(options['if'][0], branches) if 'if' in options else branches[0]
+		if 'macro' in options: run = self.macro(options['macro'][0], run)
+		for kind in ('frame', 'dialog'):
+			if kind in options: run = self.frame(kind, options[kind][0], run)
+		for kind in self.loops:
+			if kind in options: run = self.loop(kind, options[kind], run)
+		if 'h' not in options: return run
+		def block(mem):
+			run(mem)
+			return ''
+		return block
+
+	def branch(self, test, branches):
+		yes, no = branches[0], branches[1] if len(branches) > 1 else Const('')
+		return lambda mem: yes(mem) if truth(test(mem)) else no(mem)
+
+	def switch(self, value, cases):
+		# [(case value or None for default, body)]
+		branches = [(self.string(c.STRING().getText()) if c.STRING() else Const(c.NUMBER().getText()) if c.NUMBER() else None, self.visit(c.code() or c.stat_expr())) for c in cases]
+		def switch(mem):
+			key, default = unicode(value(mem)), None
+			for case, run in branches:
+				if case is None: default = default or run
+				elif unicode(case(mem)) == key: return run(mem)
+			return default(mem) if default else ''
+		return switch
+
+	def macro(self, name, run):
+		def macro(mem):
+			func = mem.get('macro', None)
+			if func is None: raise ParseError('Unknown function <macro>')
+			return func(name(mem), run(mem))
+		return macro
+
+	def frame(self, kind, name, run):
+		def frame(mem):
+			mem[(kind, unicode(name(mem)))] = run(mem)
+			return ''
+		return frame
+
+	def loop(self, kind, args, run):
+		separator = args[self.loops[kind]] if len(args) > self.loops[kind] else Const(u', ')
+		def count(mem):
+			for index in xrange(int(args[0](mem))):
+				mem['roll.count'] = index
+				yield
+		def for_(mem):
+			step = int(args[3](mem)) if len(args) > 3 else 1
+			if not step: raise ValueError('for step is 0')
+			for index in xrange(int(args[1](mem)), int(args[2](mem)), step):
+				mem[args[0].name] = index
+				yield
+		def foreach(mem):
+			for item in items(args[1](mem), *[unicode(args[3](mem))] if len(args) > 3 else []):
+				mem[args[0].name] = item
+				yield
+		def while_(mem):
+			while truth(args[0](mem)): yield
+		iterations = {'count': count, 'for': for_, 'foreach': foreach, 'while': while_}[kind]
+		def loop(mem):
+			out = []
+			for index, _ in enumerate(iterations(mem)):
+				if index >= self.maxLoops: raise ParseError('%s ran more than %s times' % (kind, self.maxLoops))
+				out.append(unicode(run(mem)))
+			return unicode(separator(mem)).join(out)
+		return loop
+
+	def visitStat_expr(self, ctx): return self.visit(ctx.assign() or ctx.expr())
+
+	def visitAssign(self, ctx):
+		name, value = ctx.NAME().getText(), self.visit(ctx.expr())
+		def assign(mem):
+			mem[name] = ret = value(mem)
+			return ret
+		return assign
+
 	def visitExpr(self, ctx):
-		if ctx.NUMBER() is not None: return self.visitNumber(ctx.NUMBER())
-		if ctx.NAME() is not None: return self.visitName(ctx.NAME())
-		if ctx.STRING() is not None: return self.visitString(ctx.STRING())
-		if ctx.ADD() is not None: return self.visit(ctx.expr(0)) + self.visit(ctx.expr(1))
-		if ctx.MUL() is not None: return self.visit(ctx.expr(0)) * self.visit(ctx.expr(1))
-		if ctx.DIV() is not None: return self.visit(ctx.expr(0)) / self.visit(ctx.expr(1))
-		if ctx.SUB() is not None: return self.visit(ctx.expr(0)) - self.visit(ctx.expr(1))
-		if ctx.ROLL() is not None: return "rolling dice with %s" % ctx.ROLL().getText()
-		if ctx.call() is not None:
-			funcname = ctx.call().NAME().getText()
-			func = self.memory.get(funcname, None)
-			if func is None: raise ParseError('Unknown function <%s>' % funcname)
-			return apply(func, [self.visit(e) for e in ctx.call().exprlist().expr()])
+		if ctx.NUMBER() is not None: return Const(int(ctx.NUMBER().getText()))
+		if ctx.NAME() is not None:
+			name = ctx.NAME().getText()
+			def lookup(mem):
+				try: return mem[name]
+				except KeyError: raise ParseError("unkown symbol '%s'" % name)
+			# the loop variables are assigned by name
+			lookup.name = name
+			return lookup
+		if ctx.STRING() is not None: return self.string(ctx.STRING().getText())
+		if ctx.ROLL() is not None:
+			n, d = ctx.ROLL().getText().lower().split('d')
+			n, d = int(n or 1), int(d)
+			return lambda mem: mem['roll'](n, d)
+		if ctx.call() is not None: return self.visit(ctx.call())
+		children = ctx.children
 		# ( expr )
-		if len(ctx.expr()) == 1 : return self.visit(ctx.expr(0))
+		if len(children) == 3 and isinstance(children[0], terminals): return self.visit(children[1])
+		if len(children) == 2:
+			op, operand = children[0].getText(), self.visit(children[1])
+			func = operator.neg if op == '-' else lambda value: not truth(value)
+			if isinstance(operand, Const):
+				try: return Const(func(operand.value))
+				except TypeError: pass # fail at run time, if ever run
+			return lambda mem: func(operand(mem))
+		if len(children) == 3:
+			op, left, right = children[1].getText(), self.visit(children[0]), self.visit(children[2])
+			if op == '&&': return lambda mem: truth(left(mem)) and truth(right(mem))
+			if op == '||': return lambda mem: truth(left(mem)) or truth(right(mem))
+			func = self.arithmetic.get(op) or self.comparisons[op]
+			if isinstance(left, Const) and isinstance(right, Const):
+				try: return Const(func(left.value, right.value))
+				except (TypeError, ZeroDivisionError): pass # fail at run time, if ever run
+			return lambda mem: func(left(mem), right(mem))
 		raise ParseError("Unkown expression type %s" % ctx.getText())
-	def visitString(self, ctx):
-		payload = re.sub(r'%{(.*?)}', r'%(\1)s', ctx.getText())
-		payload = payload % self.memory
-		return payload
-	def visitNumber(self, ctx):
-		return ast.literal_eval(ctx.getText())
-	def visitName(self, ctx):
-		name = ctx.getText()
-		if name not in self.memory:
-			raise ParseError("unkown symbol '%s'" % name)
-		return self.memory[name]
-	def visitAssign(self, ctx):
-		name = ctx.NAME().getText()
-		self.memory[name] = self.visit(ctx.expr())
-		return self.memory[name]
+
+	def visitCall(self, ctx):
+		funcname = ctx.NAME().getText()
+		params = [self.visit(e) for e in ctx.exprlist().expr()] if ctx.exprlist() else []
+		def call(mem):
+			func = mem.get(funcname, None)
+			if func is None: raise ParseError('Unknown function <%s>' % funcname)
+			return func(*[param(mem) for param in params])
+		return call
+
+	def string(self, text):
+		# drop the quotes and the escapes, then split "a %{name} b" into ['a ', 'name', ' b']
+		parts = re.split(r'%{(.*?)}', re.sub(r'\\(.)', r'\1', text[1:-1], flags=re.S))
+		if len(parts) == 1: return Const(parts[0])
+		def string(mem):
+			try: return u''.join(unicode(mem[part]) if i%2 else part for i, part in enumerate(parts))
+			except KeyError, e: raise ParseError("unkown symbol '%s'" % e.args[0])
+		return string
+
+class MtMacro(object):
+	"""A compiled macro, run it with the token property bindings."""
+	def __init__(self, source):
+		self.source = source
+		self._run = MtCompiler().visit(parse(source))
+
+	def __repr__(self): return 'MtMacro<%s chars>' % len(self.source)
+
+	def __call__(self, bindings=None):
+		"""Run the macro, return (output, memory)."""
+		mem = dict(builtins)
+		if bindings: mem.update(bindings)
+		return self._run(mem), mem
+
+# source md5 => MtMacro
+_compiled = {}
+
+def compileMacro(source):
+	"""Return the compiled macro, a source is compiled once."""
+	key = hashlib.md5(source.encode('utf-8') if isinstance(source, unicode) else source).hexdigest()
+	macro = _compiled.get(key, None)
+	if macro is None: macro = _compiled[key] = MtMacro(source)
+	return macro
 
 def main(argv):
-	input = a4.FileStream(argv[1])
-	lexer = ModeMtLexer(input)
-	stream = a4.CommonTokenStream(lexer)
-	parser = ModeMtParser(stream)
-	tree = parser.mtfile()
-	visitor = MtVisitor()
-	print "*** Lexxing and parsing the code ***"
-	visitor.visit(tree)
-	print "\n*** Memory state at the end of the macro: %s "% visitor.memory
-	print "\n*** macro output:"
-	print visitor.output
-	return tree
+	with open(argv[1], 'r') as mfile: source = mfile.read()
+	macro = compileMacro(source)
+	output, memory = macro()
+	print "\n*** compiled macro output:"
+	print output
+	runs, start = 10000, time.time()
+	for _ in xrange(runs): macro()
+	print "\n*** %d compiled runs/s" % (runs/(time.time()-start))
+	return macro
 
 
 if __name__ == '__main__':
-   tree =  main(sys.argv)
+   macro =  main(sys.argv)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+# A python lexer and recursive descent parser for the ModeMt grammar.
+#
+# It follows ModeMtLexer.g4 and ModeMtParser.g4 rule for rule, and builds the
+# same trees as the parser antlr generates from them: rule contexts with the
+# accessors of the generated contexts, terminal nodes and a visitor calling
+# visit<Rule>. The tests run without java and the antlr tool, the generated
+# parser is only needed to check both agree (see test_mt.TestAntlr):
+#
+#   antlr4 -Dlanguage=Python2 -visitor ModeMtLexer.g4 ModeMtParser.g4
+
+import re
+import bisect
+
+# the MT mode tokens, a regex alternative is tried in order so the longer
+# operators come before their prefixes
+mtTokens = re.compile(r'''
+	(?P<WS>[ \t\r\n]+)
+	|(?P<ROLL>[1-9]*[0-9][dD][1-9]*[0-9]+)
+	|(?P<NAME>[a-zA-Z_.][a-zA-Z0-9_.]*)
+	|(?P<NUMBER>[0-9]+)
+	|(?P<STRING>'(?:\\[\s\S]|[^\\'])*'|"(?:\\[\s\S]|[^\\"])*")
+	|(?P<COMP_OP>==|!=|<=|>=|<|>)
+	|(?P<AND>&&)|(?P<OR>\|\|)|(?P<NOT>!)
+	|(?P<EQUAL>=)
+	|(?P<ADD>\+)|(?P<MUL>\*)|(?P<DIV>/)|(?P<SUB>-)
+	|(?P<SEMI_COLON>;)|(?P<COLON>:)|(?P<COMMA>,)|(?P<OP>\()|(?P<CP>\))
+	|(?P<OB>\{)|(?P<CLOSE_INLINE>\})|(?P<CLOSE>\])
+	|(?P<UNKNOWN>[\s\S])''', re.VERBOSE)
+# the html up to the next token of the default mode
+text = re.compile(r'(?:[^\[{}/<]|/(?!/)|<(?!!--))+')
+# the default mode tokens
+defaultTokens = {'[': 'OPEN', '{': 'OPEN_INLINE', '}': 'CB'}
+# the mode a token pushes, None pops
+modes = {'OPEN': 'MT', 'OPEN_INLINE': 'MT', 'OB': 'DEFAULT', 'CLOSE': None, 'CLOSE_INLINE': None, 'CB': None}
+# the token literals, for the error messages
+literals = {'OPEN': "'['", 'CLOSE': "']'", 'OPEN_INLINE': "'{'", 'CLOSE_INLINE': "'}'", 'OB': "'{'", 'CB': "'}'", 'OP': "'('", 'CP': "')'",
+	'COLON': "':'", 'SEMI_COLON': "';'", 'COMMA': "','", 'EQUAL': "'='", 'EOF': '<EOF>'}
+
+class Token(object):
+	def __init__(self, type, text, line, column):
+		self.type, self.text, self.line, self.column = type, text, line, column
+
+	def __repr__(self): return 'Token<%s %r %s:%s>' % (self.type, self.text, self.line, self.column)
+
+class Recognizer(object):
+	"""The error listeners of the lexer and the parser, as in the antlr runtime."""
+	def __init__(self): self._listeners = []
+	def removeErrorListeners(self): self._listeners = []
+	def addErrorListener(self, listener): self._listeners.append(listener)
+
+	def error(self, token, line, column, msg):
+		for listener in self._listeners: listener.syntaxError(self, token, line, column, msg, None)
+		# no listener raised, there's no recovery
+		raise SyntaxError("line %s:%s %s" % (line, column, msg))
+
+class MtLexer(Recognizer):
+	def __init__(self, source):
+		Recognizer.__init__(self)
+		self.source = source
+		self._lines = [m.end() for m in re.finditer('\n', source)]
+
+	def position(self, pos):
+		line = bisect.bisect_right(self._lines, pos)
+		return line+1, pos - (self._lines[line-1] if line else 0)
+
+	def tokens(self):
+		"""Return the token list, ending with EOF, the skipped tokens are dropped."""
+		source, pos, stack, tokens = self.source, 0, ['DEFAULT'], []
+		while pos < len(source):
+			start = pos
+			if stack[-1] == 'MT':
+				m = mtTokens.match(source, pos)
+				type, pos = m.lastgroup, m.end()
+			elif source.startswith('//', pos):
+				pos = min([p for p in (source.find('\r', pos), source.find('\n', pos)) if p >= 0] or [len(source)])
+				continue
+			elif source.startswith('<!--', pos) and source.find('-->', pos+4) >= 0:
+				pos = source.find('-->', pos+4) + 3
+				continue
+			elif source[pos] in defaultTokens: type, pos = defaultTokens[source[pos]], pos+1
+			else:
+				m = text.match(source, pos)
+				type, pos = 'TEXT', m.end() if m else pos+1
+			if type == 'WS': continue
+			if type in modes:
+				if modes[type]: stack.append(modes[type])
+				elif len(stack) > 1: stack.pop()
+				else: self.error(None, *self.position(start) + ("unbalanced '%s'" % source[start],))
+			tokens.append(Token(type, source[start:pos], *self.position(start)))
+		tokens.append(Token('EOF', '<EOF>', *self.position(len(source))))
+		return tokens
+
+class TerminalNode(object):
+	def __init__(self, symbol, parent):
+		self.symbol, self.parentCtx = symbol, parent
+
+	def getSymbol(self): return self.symbol
+	def getText(self): return self.symbol.text
+	def getChildCount(self): return 0
+	def accept(self, visitor): return visitor.visitTerminal(self)
+	def __repr__(self): return 'TerminalNode<%s>' % self.symbol
+
+# the rule => the tokens and the rules found more than once in the rule, their
+# accessor returns a list when called without an index
+repeated = {
+	'mtfile': ('OPEN', 'CLOSE', 'block', 'inline', 'html'),
+	'options': ('option', 'COMMA'),
+	'body': ('code', 'switch_case', 'stat_expr', 'SEMI_COLON'),
+	'expr': ('expr',),
+	'exprlist': ('expr', 'COMMA'),
+}
+
+class RuleContext(object):
+	"""A rule node, a ctx.NAME() or ctx.expr(i) attribute returns the matching children."""
+	def __init__(self, rule, parent, start):
+		self.rule, self.parentCtx, self.start, self.children = rule, parent, start, []
+
+	def getText(self): return u''.join(c.getText() for c in self.children)
+	def getChildCount(self): return len(self.children)
+	def getChild(self, i): return self.children[i]
+	def accept(self, visitor): return getattr(visitor, 'visit' + self.rule[0].upper() + self.rule[1:])(self)
+	def __repr__(self): return '%sContext<%r>' % (self.rule, self.getText())
+
+	def __getattr__(self, name):
+		if name.startswith('_'): raise AttributeError(name)
+		if name.isupper(): match = lambda c: isinstance(c, TerminalNode) and c.symbol.type == name
+		else: match = lambda c: isinstance(c, RuleContext) and c.rule == name
+		def accessor(i=None):
+			nodes = [c for c in self.children if match(c)]
+			if i is None: return nodes if name in repeated.get(self.rule, ()) else (nodes[0] if nodes else None)
+			return nodes[i] if i < len(nodes) else None
+		return accessor
+
+class MtParserVisitor(object):
+	"""The generated visitor, every visit<Rule> visits the children."""
+	def visit(self, tree): return tree.accept(self)
+
+	def visitChildren(self, ctx):
+		result = None
+		for child in ctx.children or []: result = child.accept(self)
+		return result
+
+	def visitTerminal(self, node): return None
+
+	def __getattr__(self, name):
+		if name.startswith('visit'): return self.visitChildren
+		raise AttributeError(name)
+
+class MtParser(Recognizer):
+	"""A recursive descent parser, a method per rule, stopping on the first error."""
+	# the binary operators precedence, a higher one binds first, the unary
+	# operators bind before all of them
+	precedence = {'MUL': 5, 'DIV': 5, 'ADD': 4, 'SUB': 4, 'COMP_OP': 3, 'AND': 2, 'OR': 1}
+	unary = 6
+
+	def __init__(self, lexer):
+		Recognizer.__init__(self)
+		self.lexer, self._tokens, self._pos = lexer, None, 0
+
+	def la(self, i=0):
+		return self._tokens[min(self._pos+i, len(self._tokens)-1)].type
+
+	def enter(self, rule, parent):
+		ctx = RuleContext(rule, parent, self._tokens[self._pos])
+		if parent is not None: parent.children.append(ctx)
+		return ctx
+
+	def match(self, ctx, type):
+		token = self._tokens[self._pos]
+		if token.type != type: self.fail("mismatched input %s expecting %s" % (self.display(token), literals.get(type, type)))
+		ctx.children.append(TerminalNode(token, ctx))
+		self._pos += 1
+		return token
+
+	def display(self, token): return '<EOF>' if token.type == 'EOF' else repr(token.text.encode('utf-8') if isinstance(token.text, unicode) else token.text)
+
+	def fail(self, msg):
+		token = self._tokens[self._pos]
+		self.error(token, token.line, token.column, msg)
+
+	def noViable(self): self.fail("no viable alternative at input %s" % self.display(self._tokens[self._pos]))
+
+	def entry(self):
+		self._tokens, self._pos = self.lexer.tokens(), 0
+		ctx = self.enter('entry', None)
+		self.mtfile(ctx)
+		self.match(ctx, 'EOF')
+		return ctx
+
+	def mtfile(self, parent):
+		ctx = self.enter('mtfile', parent)
+		while self.la() in ('OPEN', 'OPEN_INLINE', 'TEXT'):
+			if self.la() == 'TEXT': self.match(self.enter('html', ctx), 'TEXT')
+			elif self.la() == 'OPEN_INLINE': self.inline(ctx)
+			else:
+				self.match(ctx, 'OPEN')
+				self.block(ctx)
+				self.match(ctx, 'CLOSE')
+		return ctx
+
+	def inline(self, parent):
+		ctx = self.enter('inline', parent)
+		self.match(ctx, 'OPEN_INLINE')
+		self.stat_expr(ctx)
+		self.match(ctx, 'CLOSE_INLINE')
+
+	def block(self, parent):
+		ctx = self.enter('block', parent)
+		if self.hasOptions():
+			self.options(ctx)
+			self.match(ctx, 'COLON')
+		self.body(ctx)
+
+	def hasOptions(self):
+		"""Look ahead for the options, option (, option)* followed by a colon."""
+		i = 0
+		while self.la(i) == 'NAME':
+			i += 1
+			if self.la(i) == 'OP':
+				depth = 0
+				while True:
+					if self.la(i) in ('EOF', 'CLOSE'): return False
+					depth += {'OP': 1, 'CP': -1}.get(self.la(i), 0)
+					i += 1
+					if not depth: break
+			if self.la(i) != 'COMMA': return self.la(i) == 'COLON'
+			i += 1
+		return False
+
+	def options(self, parent):
+		ctx = self.enter('options', parent)
+		self.option(ctx)
+		while self.la() == 'COMMA':
+			self.match(ctx, 'COMMA')
+			self.option(ctx)
+
+	def option(self, parent):
+		ctx = self.enter('option', parent)
+		self.match(ctx, 'NAME')
+		if self.la() == 'OP':
+			self.match(ctx, 'OP')
+			if self.la() != 'CP': self.exprlist(ctx)
+			self.match(ctx, 'CP')
+
+	def isCase(self): return self.la() == 'NAME' and self.la(1) in ('STRING', 'NUMBER', 'COLON')
+
+	def body(self, parent):
+		ctx = self.enter('body', parent)
+		if self.la() == 'OB':
+			self.code(ctx)
+			if self.la() == 'SEMI_COLON':
+				self.match(ctx, 'SEMI_COLON')
+				self.code(ctx)
+		elif self.isCase():
+			self.switch_case(ctx)
+			while self.la() == 'SEMI_COLON':
+				self.match(ctx, 'SEMI_COLON')
+				if not self.isCase(): break
+				self.switch_case(ctx)
+		else:
+			self.stat_expr(ctx)
+			if self.la() == 'SEMI_COLON':
+				self.match(ctx, 'SEMI_COLON')
+				self.stat_expr(ctx)
+
+	def code(self, parent):
+		ctx = self.enter('code', parent)
+		self.match(ctx, 'OB')
+		self.mtfile(ctx)
+		self.match(ctx, 'CB')
+
+	def switch_case(self, parent):
+		ctx = self.enter('switch_case', parent)
+		self.match(ctx, 'NAME')
+		if self.la() in ('STRING', 'NUMBER'): self.match(ctx, self.la())
+		self.match(ctx, 'COLON')
+		if self.la() == 'OB': self.code(ctx)
+		else: self.stat_expr(ctx)
+
+	def stat_expr(self, parent):
+		ctx = self.enter('stat_expr', parent)
+		if self.la() == 'NAME' and self.la(1) == 'EQUAL':
+			assign = self.enter('assign', ctx)
+			self.match(assign, 'NAME')
+			self.match(assign, 'EQUAL')
+			self.expr(assign)
+		else: self.expr(ctx)
+
+	def expr(self, parent, level=0):
+		"""Parse the operators binding tighter than level, left associative."""
+		ctx = self.primary(parent)
+		while self.precedence.get(self.la(), 0) > level:
+			op = self.la()
+			# the left operand becomes the first child of the operation
+			parent.children.remove(ctx)
+			binary = self.enter('expr', parent)
+			binary.start, ctx.parentCtx = ctx.start, binary
+			binary.children.append(ctx)
+			self.match(binary, op)
+			self.expr(binary, self.precedence[op])
+			ctx = binary
+		return ctx
+
+	def primary(self, parent):
+		ctx = self.enter('expr', parent)
+		if self.la() in ('SUB', 'NOT'):
+			self.match(ctx, self.la())
+			self.expr(ctx, self.unary)
+		elif self.la() == 'NAME' and self.la(1) == 'OP': self.call(ctx)
+		elif self.la() in ('ROLL', 'NUMBER', 'NAME', 'STRING'): self.match(ctx, self.la())
+		elif self.la() == 'OP':
+			self.match(ctx, 'OP')
+			self.expr(ctx)
+			self.match(ctx, 'CP')
+		else: self.noViable()
+		return ctx
+
+	def call(self, parent):
+		ctx = self.enter('call', parent)
+		self.match(ctx, 'NAME')
+		self.match(ctx, 'OP')
+		if self.la() != 'CP': self.exprlist(ctx)
+		self.match(ctx, 'CP')
+
+	def exprlist(self, parent):
+		ctx = self.enter('exprlist', parent)
+		self.expr(ctx)
+		while self.la() == 'COMMA':
+			self.match(ctx, 'COMMA')
+			if self.la() == 'CP': break
+			self.expr(ctx)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python -m unittest discover -s test/antlr/mt
+# TestAntlr needs the antlr4 runtime and the parser generated from the ModeMt grammar:
+# antlr4 -Dlanguage=Python2 -visitor ModeMtLexer.g4 ModeMtParser.g4
+
+import os
+import glob
+import unittest
+
+import mt
+import fuzz
+import mtparse
+
+try:
+	import ModeMtParser
+except ImportError: ModeMtParser = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+class TestCompile(unittest.TestCase):
+	def run_(self, source, bindings=None): return mt.MtMacro(source)(bindings)[0]
+
+	def test_html(self):
+		self.assertEqual(self.run_('no macro here'), 'no macro here')
+
+	def test_arithmetic(self):
+		self.assertEqual(self.run_('[r: 7+12/4-2]'), '8')
+		self.assertEqual(self.run_('[r: (7+12)/(4-2)]'), '9')
+		self.assertEqual(self.run_('[r: 7-2*3]'), '1')
+
+	def test_assign(self):
+		output, memory = mt.MtMacro('[h: a = 2+3]a=[r: a] b=[b = a*2]')()
+		self.assertEqual(output, 'a=5 b=10')
+		self.assertEqual((memory['a'], memory['b']), (5, 10))
+
+	def test_hidden(self):
+		self.assertEqual(self.run_('x[h: 5]y'), 'xy')
+
+	def test_if(self):
+		source = '[h: test = 0][if (test): t = "yes"; t = "no"]'
+		self.assertEqual(self.run_(source), 'no')
+		self.assertEqual(self.run_('[if (3 == 2+1): t = "yes"; t = "no"]'), 'yes')
+		self.assertEqual(self.run_('[h, if (3 < 2+1): t = "yes"; t = "no"]'), '')
+		self.assertEqual(self.run_('[if (t): "yes"; "no"]', {'t': 'false'}), 'no')
+
+	def test_count(self):
+		self.assertEqual(self.run_('[count(3): 1]'), '1, 1, 1')
+		self.assertEqual(self.run_('[count(3, "-"): roll.count]'), '0-1-2')
+
+	def test_loops(self):
+		self.assertEqual(self.run_('[for(i, 0, 6, 2, ""): i]'), '024')
+		self.assertEqual(self.run_('[foreach(a, "x, y"): a]'), 'x, y')
+		self.assertEqual(self.run_('[foreach(a, l, "/"): a]', {'l': '["x", "y"]'}), 'x/y')
+		self.assertEqual(self.run_('[h: n = 3][while(n > 0, ""): n = n-1]'), '210')
+		self.assertRaises(mt.ParseError, mt.MtMacro('[while(1): 1]'))
+
+	def test_code(self):
+		source = '[r, if(a), code: {yes [r: a]};{no}]'
+		self.assertEqual(self.run_(source, {'a': 1}), 'yes 1')
+		self.assertEqual(self.run_(source, {'a': 0}), 'no')
+		self.assertEqual(self.run_('[H, IF(0): 1]'), '')
+		self.assertEqual(self.run_('[r, foreach(a, "x,y", ""), code: {<[r: a]>}]'), '<x><y>')
+
+	def test_switch(self):
+		source = '[r, switch(a), code: case "x": {X}; case 2: {two}; default: {other}]'
+		self.assertEqual([self.run_(source, {'a': a}) for a in ['x', 2, 'z']], ['X', 'two', 'other'])
+
+	def test_macro(self):
+		calls = []
+		macro = lambda name, arg: calls.append((name, arg)) or 'called'
+		self.assertEqual(self.run_('[r, macro("m@Lib"): 1+1]', {'macro': macro}), 'called')
+		self.assertEqual(calls, [('m@Lib', 2)])
+		self.assertRaises(mt.ParseError, mt.MtMacro('[macro("m@Lib"): 1]'))
+
+	def test_frame(self):
+		output, memory = mt.MtMacro('a[frame("sheet"): {<b>[r: 1+1]</b>}]b')()
+		self.assertEqual((output, memory[('frame', 'sheet')]), ('ab', '<b>2</b>'))
+
+	def test_inline(self):
+		self.assertEqual(self.run_('<p>{hp}</p>{x = 2}', {'hp': 7}), '<p>7</p>2')
+
+	def test_operators(self):
+		self.assertEqual(self.run_('[r: -2*3]'), '-6')
+		self.assertEqual(self.run_('[r: "a" + 1]'), 'a1')
+		self.assertEqual([self.run_('[r: %s]' % test) for test in ['1 != 2', '2 <= 1', '! 0', '1 && 0', '0 || 1']], ['True', 'False', 'True', 'False', 'True'])
+		self.assertIsInstance(mt.MtCompiler().visit(mt.parse('[r: !(1 >= 2)]')), mt.Const)
+
+	def test_string(self):
+		self.assertEqual(self.run_('[r: "a %{name} b"]', {'name': 'Goblin'}), 'a Goblin b')
+		self.assertEqual(self.run_('[r: \'it\\\'s\']'), "it's")
+
+	def test_roll(self):
+		self.assertEqual(self.run_('[r: 2d6]', {'roll': lambda n, d: n*d}), '12')
+		self.assertTrue(2 <= int(self.run_('[r: 2d6]')) <= 12)
+
+	def test_call(self):
+		self.assertEqual(self.run_('[r: add(1, 2)]', {'add': lambda a, b: a+b}), '3')
+
+	def test_bindings(self):
+		macro = mt.MtMacro('[r: hp]')
+		self.assertEqual(macro({'hp': 7})[0], '7')
+		self.assertEqual(macro({'hp': 12})[0], '12')
+		# a run does not leak in the next ones
+		output, memory = mt.MtMacro('[r: a = 1]')({'b': 2})
+		self.assertNotIn('a', mt.builtins)
+		self.assertNotIn('a', mt.MtMacro('[r: 1]')()[1])
+
+	def test_constant_folding(self):
+		self.assertIsInstance(mt.MtCompiler().visit(mt.parse('[r: 2*3+1]')), mt.Const)
+		self.assertNotIsInstance(mt.MtCompiler().visit(mt.parse('[r: a*3]')), mt.Const)
+
+	def test_unknown(self):
+		macro = mt.MtMacro('[r: missing]')
+		self.assertRaises(mt.ParseError, macro)
+		self.assertRaises(mt.ParseError, mt.MtMacro('[r: missing(1)]'))
+		self.assertRaises(mt.ParseError, mt.MtMacro('[r: "%{missing}"]'))
+
+	def test_cache(self):
+		macro = mt.compileMacro('[r: 1+1]')
+		self.assertIs(mt.compileMacro('[r: 1+1]'), macro)
+		self.assertIs(mt.compileMacro(u'[r: 1+1]'), macro)
+		self.assertIsNot(mt.compileMacro('[r: 1+2]'), macro)
+
+	def test_sample(self):
+		with open(os.path.join(here, 'sample1.mtmacro'), 'r') as mfile: output, memory = mt.compileMacro(mfile.read())()
+		self.assertEqual([memory['var%s' % i] for i in [1, 3, 4, 5, 6, 7, 8]], [5, 14, 21, 3, 5, 8, 9])
+		self.assertIn('test3=true', output)
+
+class TestErrors(unittest.TestCase):
+	def error(self, source):
+		with self.assertRaises(mt.MtSyntaxError) as ctx: mt.parse(source)
+		return ctx.exception
+
+	def test_position(self):
+		e = self.error('[a = ]')
+		self.assertEqual((e.line, e.column), (1, 5))
+		e = self.error('line 1\n[a = 1]\n[b = (1]')
+		self.assertEqual(e.line, 3)
+
+	def test_invalid(self):
+		for source in ['[a = 1', '[if (1): a = 1; b; c]', '[count(): 1]', '[a = 1 +]', '[r: )]', '{a', '[h: a] }']:
+			self.error(source)
+
+	def test_options(self):
+		self.assertEqual(self.error('[h, bogus(1): 1]').msg, "unknown roll option 'bogus'")
+		self.assertEqual(self.error('[h, macro(): 1]').msg, "roll option 'macro' takes 1 arguments, not 0")
+		self.assertEqual(self.error('[foreach(1, l): 1]').msg, "roll option 'foreach' needs a variable name")
+		self.assertEqual(self.error('[h: {a}]').msg, "code block without the code, frame or dialog option")
+		self.assertEqual(self.error('[h: a; b]').msg, "else branch without the if option")
+		self.assertEqual(self.error('[switch(a): 1]').msg, "switch option without case")
+		e = self.error('[r: case "a": {b}]')
+		self.assertEqual((e.column, e.msg), (4, "case without the switch option"))
+		self.error('[switch(a), code: case: {b}]')
+		# nested blocks are checked too
+		self.assertEqual(self.error('[code: {\n [H, oops: 1]}]').line, 2)
+
+	def test_compile(self):
+		self.assertRaises(mt.MtSyntaxError, mt.compileMacro, '[a = ]')
+		self.assertRaises(mt.MtSyntaxError, mt.MtMacro, '[a = ]')
+
+	def test_no_recovery(self):
+		# the default antlr listeners print the error on stderr and recover
+		self.assertRaises(mt.MtSyntaxError, mt.parse, 'ok [a = = 1] ok')
+
+	def test_lexer(self):
+		e = self.error('ok\n }')
+		self.assertEqual((e.line, e.column), (2, 1))
+		self.error('[a = "no end]')
+
+class TestParser(unittest.TestCase):
+	def test_tree(self):
+		tree = mt.parse('a <!-- b --> c [h: x = 1+2*3] // d\n').mtfile()
+		self.assertEqual([c.getText() for c in tree.html()], ['a ', ' c ', ' ', '\n'])
+		self.assertEqual(tree.block(0).options().option(0).NAME().getText(), 'h')
+		expr = tree.block(0).body().stat_expr(0).assign().expr()
+		self.assertEqual([c.getText() for c in expr.children], ['1', '+', '2*3'])
+		self.assertEqual(expr.expr(1).MUL().getSymbol().column, 26)
+
+	def test_precedence(self):
+		expr = lambda source: mt.parse(source).mtfile().block(0).body().stat_expr(0).expr()
+		self.assertEqual(expr('[7-2-1]').expr(0).getText(), '7-2')
+		self.assertEqual(expr('[-a*b]').expr(0).getText(), '-a')
+		self.assertEqual(expr('[a || b && !c == d]').expr(1).getText(), 'b&&!c==d')
+
+	def test_library(self):
+		# the shipped macros, but the ones using jinja
+		for fp in ['checkme', 'cpanel', 'output', 'rollDice', 'saveme', 'init', 'description']:
+			with open(os.path.join(fuzz.library, fp + '.mtmacro'), 'r') as mfile: mt.parse(mfile.read().decode('utf-8'))
+
+def dump(node):
+	"""The rule names and token texts of a parse tree, the consecutive html merged."""
+	if isinstance(node, mt.terminals): return node.getText()
+	if isinstance(node, mtparse.RuleContext): name = node.rule
+	else: name = type(node).__name__[0].lower() + type(node).__name__[1:-len('Context')]
+	children = []
+	for child in map(dump, node.children or []):
+		if children and child[0] == 'html' == children[-1][0]: children[-1] = ('html', children[-1][1] + child[1])
+		else: children.append(child)
+	return (name, ) + tuple(children) if name != 'html' else (name, node.getText())
+
+@unittest.skipIf(ModeMtParser is None, 'the antlr4 runtime or the generated parser is missing')
+class TestAntlr(unittest.TestCase):
+	"""The python parser builds the same trees as the antlr one."""
+	def test_library(self):
+		files = glob.glob(os.path.join(here, '*.mtmacro')) + glob.glob(os.path.join(fuzz.library, '*.mtmacro'))
+		for fp in sorted(files):
+			with open(fp, 'r') as mfile: source = mfile.read().decode('utf-8')
+			try: expected = dump(mt.parseAntlr(source))
+			except mt.MtSyntaxError:
+				self.assertRaises(mt.MtSyntaxError, mt.parse, source)
+				continue
+			self.assertEqual(dump(mt.parse(source)), expected, fp)
+
+class TestFuzz(unittest.TestCase):
+	def test_sample(self):
+		with open(os.path.join(here, 'sample1.mtmacro'), 'r') as mfile: sources = [mfile.read()]
+		counts, bugs = fuzz.fuzz(sources, 500, seed=1)
+		self.assertEqual(bugs, [])
+		self.assertTrue(counts['ran'])
+
+	def test_library(self):
+		self.assertEqual(fuzz.main(['--runs', '200', '--seed', '2']), 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python -m unittest discover -s test -p 'test_*.py'
+# the Fetcher against a local http server: retries, backoff and revalidation
+
+import os
+import sys
+import json
+import unittest
+import threading
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fetch
+from fetch import Fetcher
+from store import Store
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Answer with the next scripted (status, headers, body) of the path, 404 when none is left."""
+	def do_GET(self):
+		self.server.requests.append((self.path, dict(self.headers)))
+		script = self.server.scripts.get(self.path)
+		status, headers, body = script.pop(0) if script else (404, {}, '')
+		if status == 200 and 'ETag' in headers and self.headers.get('If-None-Match') == headers['ETag']: status, body = 304, ''
+		self.send_response(status)
+		for key, value in headers.iteritems(): self.send_header(key, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args): pass
+
+class Clock(object):
+	"""Stands for the fetch time module, records the sleeps instead of sleeping."""
+	def __init__(self): self.sleeps = []
+	def sleep(self, seconds): self.sleeps.append(seconds)
+
+class TestFetcher(unittest.TestCase):
+	def setUp(self):
+		self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+		self.server.scripts, self.server.requests = {}, []
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.base = 'http://127.0.0.1:%s/api/' % self.server.server_port
+		self.time, fetch.time = fetch.time, Clock()
+		self.clock = fetch.time
+
+	def tearDown(self):
+		fetch.time = self.time
+		self.server.shutdown()
+		self.server.server_close()
+
+	def script(self, path, *responses): self.server.scripts[path] = list(responses)
+
+	def test_retry(self):
+		body = json.dumps({'name': 'Goblin'})
+		self.script('/api/monsters/goblin', (503, {}, ''), (429, {}, ''), (200, {}, body))
+		self.assertEqual(Fetcher(self.base, backoff=0.5).get('monsters/goblin'), {'name': 'Goblin'})
+		self.assertEqual(len(self.server.requests), 3)
+		self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+
+	def test_give_up(self):
+		self.script('/api/monsters/goblin', *[(503, {}, '')]*5)
+		fetcher = Fetcher(self.base, retries=3, backoff=1)
+		self.assertRaises(fetch.requests.HTTPError, fetcher.get, 'monsters/goblin')
+		self.assertEqual(len(self.server.requests), 4)
+		self.assertEqual(self.clock.sleeps, [1, 2, 4])
+
+	def test_no_retry(self):
+		self.script('/api/monsters/goblin', (404, {}, ''))
+		self.assertRaises(fetch.requests.HTTPError, Fetcher(self.base).get, 'monsters/goblin')
+		self.assertEqual((len(self.server.requests), self.clock.sleeps), (1, []))
+
+	def test_not_modified(self):
+		body = json.dumps({'name': 'Goblin', 'hit_points': 7})
+		response = (200, {'ETag': '"v1"'}, body)
+		self.script('/api/monsters/goblin', response, response)
+		with Store(':memory:') as store:
+			self.assertEqual(Fetcher(self.base, store=store).get('monsters/goblin')['hit_points'], 7)
+			fetcher = Fetcher(self.base, store=store)
+			self.assertEqual(fetcher.get('monsters/goblin')['hit_points'], 7)
+		self.assertEqual(fetcher.notModified, 1)
+		self.assertNotIn('if-none-match', self.server.requests[0][1])
+		self.assertEqual(self.server.requests[1][1]['if-none-match'], '"v1"')
+
+	def test_fetch_all(self):
+		names = ['Goblin', 'Orc', 'Kobold']
+		listing = {'count': 3, 'results': [{'name': name, 'url': '/api/monsters/%s' % name.lower()} for name in names]}
+		self.script('/api/monsters/', (200, {}, json.dumps(listing)))
+		for name in names: self.script('/api/monsters/%s' % name.lower(), (503, {}, ''), (200, {}, json.dumps({'name': name})))
+		self.assertEqual([item['name'] for item in Fetcher(self.base, jobs=2).fetchAll('monsters')], names)
+		self.assertEqual(len(self.clock.sleeps), 3)
+
+if __name__ == '__main__':
+	unittest.main()
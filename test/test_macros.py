@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python -m unittest discover -s test -p 'test_*.py'
+# the attacks parsed from the stat blocks, and the macros built from them
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import macros
+
+class Token(object):
+	name = 'Goblin'
+
+scimitar = {'name': 'Scimitar', 'desc': 'Melee Weapon Attack: +4 to hit, reach 5 ft., one target. Hit: 5 (1d6 + 2) slashing damage.', 'attack_bonus': 4, 'damage_dice': '1d6', 'damage_bonus': 2}
+bite = {'name': 'Bite', 'desc': 'Melee Weapon Attack: +6 to hit, reach 10 ft., one target. Hit: 11 (2d6 + 4) piercing damage plus 7 (2d6) fire damage.'}
+multiattack = {'name': 'Multiattack', 'desc': u'The dragon makes three attacks: one with its bite and two with its claws — or it breathes.'}
+
+# the commands of the macros before the attacks were parsed once, with precompiled patterns
+weapon = u'''[h:jsonWeaponData = json.set("{}",
+	"Name", "%s",
+	"DamageDie", "%s",
+	"DamageBonus",%s,
+	"DamageType","%s",
+	"HitBonus",%s,
+	"SecDamageType", 0,
+	"SecDamageDie", 0,
+	"SecDamageBonus",0,
+	"SpecialAbility","",
+	"Description", "%s",
+	"FlavorText","Goblin attacks!",
+	"ButtonColor","green",
+	"FontColor","white")]
+[macro("NPCAttack@Lib:Addon5e"):jsonWeaponData]'''
+expected = {
+	'Scimitar': ('Scimitar +4 1d6+2', weapon % ('Scimitar +4 1d6+2', '1d6', 2, 'slashing', 4, scimitar['desc'])),
+	'Bite': ('Bite +6 2d6+4', weapon % ('Bite +6 2d6+4', '2d6', 4, 'piercing', 6, bite['desc'])),
+	'Multiattack': ('Multiattack', u'''[h:data = json.set("{}",
+	"Name", "Multiattack",
+	"Description", "The dragon makes three attacks: one with its bite and two with its claws &#8212; or it breathes.")]
+
+[macro("Description@Lib:Addon5e"):data]'''),
+}
+
+class TestAttack(unittest.TestCase):
+	def test_fields(self):
+		self.assertEqual(macros.parseAttack(scimitar), macros.Attack(4, '1d6', 2, 'slashing', 5, '', ''))
+		self.assertEqual(macros.parseAttack(bite), macros.Attack('6', '2d6', '4', 'piercing', 10, '2d6', 'fire'))
+		self.assertEqual(macros.parseAttack(multiattack), macros.Attack(0, '', 0, '', 0, '', ''))
+
+	def test_secondary(self):
+		attack = macros.parseAttack({'desc': 'Hit: 9 (1d8 + 5) slashing damage plus 3 (1d6) poison damage, or plus 10 (3d6) if prone.'})
+		self.assertEqual((attack.secondary_dice, attack.secondary_type), ('1d6', 'poison'))
+
+	def test_macro(self):
+		for action in [scimitar, bite, multiattack]:
+			macro = macros.ActionMacro(Token(), action)
+			self.assertEqual((macro.label, macro.command), expected[action['name']])
+		self.assertEqual(macros.ActionMacro(Token(), bite).secondary_type, 'fire')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python -m unittest discover -s test -p 'test_*.py'
+# the macros validation: the parse of the commands, the parse cache and the report
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+here = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, here)
+import validate
+import macros
+from util import jenv
+
+class Token(object):
+	"""Stands for a token, only its name and macros are validated."""
+	def __init__(self, name): self.name, self.macros = name, []
+	def add(self, macro): self.macros.append(macro)
+
+class TestValidate(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.token = Token('Goblin')
+
+	def tearDown(self): shutil.rmtree(self.tmp)
+
+	def macro(self, label, command): self.token.add(macros.Macro(self.token, '', label, command))
+
+	def test_check(self):
+		self.assertIsNone(validate.check(u'[h, if(argCount() > 2): d = arg(2); d = 0]'))
+		self.assertEqual(validate.check(u'[h, if(argCount() > 2): d = arg(2); d = 0)]'), (1, 41, "mismatched input ')' expecting ']'"))
+
+	def test_validate(self):
+		self.macro('ok', '[r, macro("Description@Lib:Addon5e"): "x"]')
+		self.macro('broken', '[h: a = ]')
+		self.token.add(macros.DescrMacro(self.token, {'name': 'Bite', 'desc': u'a "quoted" bite'}))
+		errors = validate.MacroValidator(jobs=1).validate([self.token])
+		self.assertEqual([(command, position) for command, position, _ in errors][0], ('[h: a = ]', (1, 8, "no viable alternative at input ']'")))
+		self.assertEqual([[macro.label for token, macro in used] for _, _, used in errors], [['broken'], ['Bite']])
+
+	def test_cache(self):
+		fp = os.path.join(self.tmp, 'macros.validate')
+		self.macro('ok', '[r: 1]')
+		self.macro('same', '[r: 1]')
+		self.macro('broken', '[r: 1')
+		validator = validate.MacroValidator(fp)
+		self.assertEqual(len(validator.validate([self.token])), 1)
+		self.assertEqual((validator.hits, validator.misses), (0, 2))
+		validator = validate.MacroValidator(fp)
+		self.assertEqual(len(validator.validate([self.token])), 1)
+		self.assertEqual((validator.hits, validator.misses), (2, 0))
+
+	def test_library(self):
+		# the Lib:Addon5e macros, rendered like the build does
+		for name in ['castSpell', 'checkme', 'cpanel', 'description', 'init', 'npcAttack', 'output', 'rollDice', 'saveme']:
+			with open(os.path.join(here, 'macros', name + '.mtmacro'), 'r') as mfile:
+				self.macro(name, jenv().from_string(mfile.read().decode('utf-8')).render())
+		self.assertEqual(validate.MacroValidator(jobs=2).validate([self.token]), [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -4,23 +4,28 @@
 import os
 import re
 import json
-import requests
 import logging
 import zipfile
-import jinja2
 import glob
-import difflib
 import pickle
 import argparse
 import itertools
 import collections
 import codecs
+import multiprocessing
+import hashlib
+import inspect
+import io
+from jinja2 import escape
 
 # local import
 import macros
-from util import Img, jenv, guid
-from zone import Zone
+from util import Img, ImgIndex, AssetRegistry, Writer, jenv, guid, configureImgCache, configureImgEncoder, configureAssetCache, configureTemplateCache, templates, profiler
+from zone import Zone, shard
 from cmpgn import Campaign, PSet
+from store import Store
+from fetch import Fetcher
+import validate
 
 log = logging.getLogger()
 
@@ -31,14 +36,17 @@ if not os.path.exists(imglib):
 imglibs = [imglib] + [ imglib+"/%s"%sub for sub in ['volo', 'Tome of Beasts'] ]
 
 args = None
+# rptok filename => [fingerprint of the inputs it was built from, md5 of the file]
+manifest = {}
+# the rptok files writer thread of the main process, None to write them in the build loop
+writer = None
 
-def dnd5Api(category):
-	"""Fetch all category items from the dnd database"""
-	items = requests.post(ubase+category+'/').json()
-	log.info("Found %s %s" % (items['count'], category))
-	for item in items['results']:
-		log.info("fetching %s" % item['name'])
-		yield requests.get(item['url']).json()
+# stat block modifiers, like "Perception +5, Sleight of Hand +4" or "Dex +8, Con -1"
+modifierPattern = re.compile(r'([A-Za-z][A-Za-z ]*?) ([+-]\d+)')
+
+def htmlItems(items):
+	"""The sheet html of the specials or actions, like the token_sheet.mtmacro loops."""
+	return u''.join(u'<p><b>%s</b> %s</p>' % (escape(item['name']), escape(item['desc'])) for item in items)
 
 class State(object):
 	def __init__(self, name, value):
@@ -46,20 +54,21 @@ class State(object):
 		self.value = value
 	def __repr__(self): return 'S<%s,%s>' % (self.name, self.value)
 
-class Prop(object):
-	def __init__(self, name, value):
-		self.name = name
-		self.value = value
-	def __repr__(self): return '%s<%s,%s>' % (self.__class__.__name__, self.name, self.value)
-	def render(self):
-		return jinja2.Template(u'''      <entry>
+templates['prop.template'] = u'''      <entry>
         <string>{{prop.name.lower()}}</string>
         <net.rptools.CaseInsensitiveHashMap_-KeyValue>
           <key>{{prop.name}}</key>
           <value class="string">{{prop.value}}</value>
           <outer-class reference="../../../.."/>
         </net.rptools.CaseInsensitiveHashMap_-KeyValue>
-      </entry>''').render(prop=self)
+      </entry>'''
+
+class Prop(object):
+	def __init__(self, name, value):
+		self.name = name
+		self.value = value
+	def __repr__(self): return '%s<%s,%s>' % (self.__class__.__name__, self.name, self.value)
+	def render(self): return jenv().get_template('prop.template').render(prop=self)
 
 def all_skills(all_skills={}):
 	if not all_skills:
@@ -71,26 +80,50 @@ def all_skills(all_skills={}):
 	return all_skills
 
 class Dnd5ApiObject(object):
-	sfile_name = 'nofile.pickle' # filename used for serialization
+	sfile_name = 'dnd5.db' # the Store used for serialization
 	category = 'unknown'
 
 	@classmethod
-	def load(cls, build_dir):
-		items = None
+	def load(cls, build_dir, names=None):
+		"""Return the stored items, all of them or only the named ones, fetch them from the api if none are stored."""
 		fp = os.path.join(build_dir, cls.sfile_name)
 		if os.path.exists(fp):
-			log.warning('Found serialized %ss, delete %s to refresh the items from %s' % (cls.__name__, fp, ubase))
-			with open(fp, 'r') as fpickle:
-				items = pickle.load(fpickle)
-		return iter(items) if items else (cls(item) for item in dnd5Api(cls.category))
+			with Store(fp) as store:
+				if store.count(cls.category):
+					log.info('Found %s stored %ss in %s' % (store.count(cls.category), cls.__name__, fp))
+					return iter([cls(js) for js in store.load(cls.category, names)])
+		return cls.fetch(build_dir)
 
 	@classmethod
-	def dump(cls, build_dir, items):
-		# serialize the data if not already done
+	def fetch(cls, build_dir, base=ubase, jobs=8):
+		"""Fetch all the items from the api and store them as the 'api' source, the stored ones the api no longer has are deleted."""
+		with Store(os.path.join(build_dir, cls.sfile_name)) as store:
+			items = [cls(js) for js in Fetcher(base, jobs, store=store).fetchAll(cls.category)]
+			store.put(cls.category, (item.js for item in items), source='api', prune=True)
+		return iter(items)
+
+	@classmethod
+	def stored(cls, build_dir, source):
+		"""Return the json data of the stored items of the source, an empty list if none."""
 		fp = os.path.join(build_dir, cls.sfile_name)
-		if not os.path.exists(fp):
-			with open(fp, 'w') as fpickle:
-				pickle.Pickler(fpickle).dump(list(items))
+		if not os.path.exists(fp): return []
+		with Store(fp) as store:
+			return list(store.load(cls.category, source=source))
+
+	@classmethod
+	def get(cls, build_dir, name):
+		"""Return the stored item with the given name, None if not stored."""
+		fp = os.path.join(build_dir, cls.sfile_name)
+		if not os.path.exists(fp): return None
+		with Store(fp) as store:
+			js = store.get(cls.category, name)
+		return cls(js) if js is not None else None
+
+	@classmethod
+	def dump(cls, build_dir, items):
+		"""Store the items, only the ones that changed are written."""
+		with Store(os.path.join(build_dir, cls.sfile_name)) as store:
+			store.put(cls.category, (item.js for item in items))
 
 	def __init__(self, js):
 		self.js = js
@@ -116,11 +149,46 @@ class Dnd5ApiObject(object):
 	def __getstate__(self): return {'js' : self.js}
 	def __setstate__(self, state): self.js = state['js']
 
+class SpellIndex(object):
+	"""A word trie of the spell names, finds the spells mentioned in a text in one pass."""
+	wordPattern = re.compile(r"[\w']+", re.UNICODE)
+	def __init__(self, spells):
+		self.trie = {}
+		for index, spell in enumerate(spells):
+			node = self.trie
+			for word in self.words(spell.name.lower()): node = node.setdefault(word, {})
+			node.setdefault(None, []).append(index) # None marks the end of a name
+	def __repr__(self): return 'SpellIndex<%s names>' % len(self.trie)
+
+	def words(self, text): return self.wordPattern.findall(text.replace(u'\u2019', "'"))
+
+	def find(self, text):
+		"""Return the set of spell indexes mentioned in text, the longest name wins on overlaps."""
+		words = self.words(text)
+		found = set()
+		start = 0
+		while start < len(words):
+			node, match, end = self.trie, None, start+1
+			for pos in xrange(start, len(words)):
+				node = node.get(words[pos], None)
+				if node is None: break
+				if None in node: match, end = node[None], pos+1
+			if match: found.update(match)
+			start = end
+		return found
+
 class Spell(Dnd5ApiObject):
-	sfile_name = 'spells.pickle'
 	category = 'spells'
 	spellDB = []
 	pattern = r'(\d+d\d+) (\w+) damage'
+	_index = None # (spellDB, SpellIndex)
+
+	@classmethod
+	def index(cls):
+		"""The SpellIndex of spellDB, rebuilt when spellDB is replaced."""
+		if cls._index is None or cls._index[0] is not cls.spellDB:
+			Spell._index = (cls.spellDB, SpellIndex(cls.spellDB))
+		return cls._index[1]
 
 	@property
 	def html_desc(self): return ' '.join(self.js['desc']).replace("'", "&#39;")
@@ -173,9 +241,11 @@ class Spell(Dnd5ApiObject):
 
 class Token(Dnd5ApiObject):
 	sentinel = object()
-	sfile_name = 'tokens.pickle'
 	category = 'monsters'
-	pngFiles = sentinel
+	imgIndex = sentinel
+	# files the rptok content depends on, beside the token json data
+	sources = ['tokens.py', 'macros.py', 'util.py', 'templates/*.template', 'macros/token_sheet.mtmacro', '../5e-database/5e-SRD-Ability-Scores.json']
+	_digests = {}
 	def __init__(self, js):
 		self.js = js
 		self._assets = None
@@ -196,31 +266,28 @@ class Token(Dnd5ApiObject):
 		Dnd5ApiObject.__setstate__(self, state)
 		self._guid = self.sentinel
 		self._assets = None
+		self._macros = []
+		self.x, self.y = 0, 0
 
 	@property
 	def assets(self):
 		if self._assets is None:
-			self._assets = {}
-			# try to fetch an appropriate image from the imglib directory
-			# using a stupid heuristic: the image / token.name match ratio
-			# compute the diff ratio for the given name compared to the token name
-			ratio = lambda name: difflib.SequenceMatcher(None, name.lower(), self.name.lower()).ratio()
-			# morph "/abc/def/anyfile.png" into "anyfile"
-			short_name = lambda full_path: os.path.splitext(os.path.basename(full_path))[0]
-			bratio=0
-			if self.pngs:
-				# generate the diff ratios
-				ratios = ((f, ratio(short_name(f))) for f in self.pngs)
-				# pickup the best match, it's a tuple (fpath, ratio)
-				bfpath, bratio = max(itertools.chain(ratios, [('', 0)]), key = lambda i: i[1])
-				log.debug("Best match from the img lib is %s(%s)" % (bfpath, bratio))
-			# in delivery mode, do not add the tome of beast art, per author request
-			if bratio > 0.8 and (self.js.get("ref", "")!="Tome of Beast" or not args.delivery):
-				self._assets['null'] = Img(bfpath)
-			else:
-				self._assets['null'] = Img(imglib+'/dft.png')
+			with profiler.stage('Token.assets', self.name):
+				self._assets = {'null': Img(self.imgPath)}
 		return self._assets
 
+	@property
+	def imgPath(self):
+		"""The path of the token image."""
+		# try to fetch an appropriate image from the imglib directory
+		# using a stupid heuristic: the image / token.name match ratio
+		bfpath, bratio = self.imgs.match(self.name)
+		log.debug("Best match from the img lib is %s(%s)" % (bfpath, bratio))
+		# in delivery mode, do not add the tome of beast art, per author request
+		if bratio > 0.8 and (self.js.get("ref", "")!="Tome of Beast" or not args.delivery):
+			return bfpath
+		return imglib+'/dft.png'
+
 	@property
 	def guid(self):
 		if self._guid is self.sentinel:
@@ -229,7 +296,8 @@ class Token(Dnd5ApiObject):
 
 	@property
 	def content_xml(self):
-		return jenv().get_template('content.template').render(token=self) or u''
+		with profiler.stage('Token.content_xml', self.name):
+			return jenv().get_template('content.template').render(token=self) or u''
 
 	@property
 	def properties_xml(self):
@@ -327,6 +395,23 @@ class Token(Dnd5ApiObject):
 			saves = ", ".join([ '%s %+d'% (attr[:3], self.js["%s_save"%attr.lower()]) for attr in self.attributes if "%s_save" % attr.lower()  in self.js])
 		return saves
 
+	@property
+	def jskills(self):
+		"""The skill modifiers, like {"Perception": 5}, the ability modifier unless the stat block has it."""
+		skills = dict((skill, self.abonus(attribute)) for skill, attribute in all_skills().iteritems())
+		skills.update((skill.lower(), int(modifier)) for skill, modifier in modifierPattern.findall(self.skills))
+		return collections.OrderedDict((' '.join(w if w == 'of' else w.capitalize() for w in skill.split()), modifier) for skill, modifier in sorted(skills.iteritems()))
+
+	@property
+	def jsaves(self):
+		"""The saving throw modifiers, like {"Str": 0}, the ability modifier unless the stat block has it."""
+		saves = dict((attr[:3], self.abonus(attr)) for attr in self.attributes)
+		saves.update((attr.split()[-1][:3].capitalize(), int(modifier)) for attr, modifier in modifierPattern.findall(self.saves))
+		return collections.OrderedDict((attr[:3], saves[attr[:3]]) for attr in self.attributes)
+
+	@property
+	def initiative(self): return self.jskills.get('Initiative', self.bdex)
+
 	@property
 	def note(self): return ''
 
@@ -367,14 +452,16 @@ class Token(Dnd5ApiObject):
 		specials = (macros.SpecialMacro(self, spe) for spe in self.specials if spe['name'] and spe['name'].lower()!="spellcasting")
 		spells = (macros.SpellMacro(self, spell) for spell in self.spells)
 		commons = [
-			macros.SheetMacro(self),
+			# thin tokens call the sheet shared by the Lib token
+			macros.Macro(self, None, 'Sheet', '[macro("Sheet@Lib:Addon5e"):0]', **{'group': 'Sheet', 'colors': ('black', 'yellow'), 'tooltip': 'Display the NPC sheet'}) if args.thin else macros.SheetMacro(self),
 			macros.Macro(self, None, 'Init', '[macro("Init@Lib:Addon5e"):0]', **{'group': 'Rolls', 'colors': ('white', 'green'), 'tooltip': 'Roll and add to the init panel'}),
 			macros.Macro(self, None, 'SaveMe', '[macro("SaveMe@Lib:Addon5e"):0]', **{'group': 'Rolls', 'colors': ('white', 'green'), 'tooltip': 'Roll Saving Throws'}),
 			macros.Macro(self, None, 'CheckMe', '[macro("CheckMe@Lib:Addon5e"):0]', **{'group': 'Rolls', 'colors': ('white', 'green'), 'tooltip': 'Roll Skill Checks'}),
 		]
 		if not args.delivery: 
 			commons.append(macros.Macro(self, None, 'Debug', '[r: a5e.debug()]', **{'group': 'zDebug', 'colors': ('white', 'black')}))
-		self._macros = list(itertools.chain(actions, spellCast, specials, legends, lairs, reg, commons, spells))
+		with profiler.stage('Token.macros', self.name):
+			self._macros = list(itertools.chain(actions, spellCast, specials, legends, lairs, reg, commons, spells))
 		return self._macros
 
 	@property
@@ -413,7 +500,7 @@ class Token(Dnd5ApiObject):
 	def spells(self):
 		spells = []
 		for ability in (a for a in self.specials if 'spellcasting' in a['name'].lower()):
-			spells.extend([s for s in Spell.spellDB if s.name.lower() in ability['desc']])
+			spells.extend(Spell.spellDB[i] for i in sorted(Spell.index().find(ability['desc'])))
 		return spells
 
 	@property
@@ -434,7 +521,7 @@ class Token(Dnd5ApiObject):
 			('Wisdom', self.wisdom),
 			('Intelligence', self.intelligence),
 			('Charisma', self.charisma),
-			('Initiative', '[h,macro("getNPCInitBonus@Lib:Addon5e"):0][r: macro.return]'),
+			('Initiative', self.initiative),
 			('Immunities', self.immunities), # XXX add condition immunities ?
 			('Resistances', self.resistances),
 			('CreatureType', self.type + ', CR ' + str(self.challenge_rating)),
@@ -442,7 +529,8 @@ class Token(Dnd5ApiObject):
 			('Speed', self.speed),
 			('Saves', self.saves),
 			('Skills', self.skills),
-			('jSkills', '[h,macro("getNPCSkills@Lib:Addon5e"):0][r: macro.return]'),
+			('jSkills', json.dumps(self.jskills)),
+			('jSaves', json.dumps(self.jsaves)),
 			('Senses', self.senses),
 			('Vulnerabilities', self.vulnerabilities),
 			('Resistances', self.resistances),
@@ -451,16 +539,22 @@ class Token(Dnd5ApiObject):
 			('passive perception', self.passive_perception),
 			('ImageName', self.img.name),
 			('SpellSlots', self.spell_slots),
-			# do ('bstr', '{floor((getProperty("Strength")-10)/2)}') for all attributes
-			] + [('b%s' % a[:3].lower(), '{floor((getProperty("%s")-10)/2)}' % a) for a in self.attributes] +
+			# do ('bstr', -1) for all attributes
+			] + [('b%s' % a[:3].lower(), self.abonus(a)) for a in self.attributes] +
+			# the thin sheet content, xml escaped html
+			([('SheetSpecials', escape(htmlItems(self.specials))), ('SheetActions', escape(htmlItems(self.actions)))] if args.thin else []) +
 			[(k, v) for k,v in self.slots.iteritems()]
 			)
 
+	@classmethod
+	def imgLib(cls):
+		"""The image library index, built once per process."""
+		if Token.imgIndex is cls.sentinel:
+			Token.imgIndex = ImgIndex(itertools.chain(*(glob.glob(os.path.join(os.path.expanduser(imglib), '*.png')) for imglib in imglibs)))
+		return Token.imgIndex
+
 	@property
-	def pngs(self):
-		if self.pngFiles is self.sentinel:
-			Token.pngFiles = list(itertools.chain(*(glob.glob(os.path.join(os.path.expanduser(imglib), '*.png')) for imglib in imglibs)))
-		return iter(self.pngFiles) if self.pngFiles else None
+	def imgs(self): return self.imgLib()
 
 	@property
 	def img(self): return self.assets.get('null', None)
@@ -468,29 +562,59 @@ class Token(Dnd5ApiObject):
 	@property
 	def states(self): return [s for s in [State('Concentrating', 'false')]]
 
-	def zipme(self):
-		"""Zip the token into a rptok file."""
+	@classmethod
+	def sourcesDigest(cls):
+		"""md5 of the sources files, computed once per class."""
+		if cls not in cls._digests:
+			md5 = hashlib.md5()
+			for fp in sorted(itertools.chain(*(glob.glob(pattern) for pattern in cls.sources))):
+				with open(fp, 'rb') as sfile: md5.update(sfile.read())
+			cls._digests[cls] = md5.hexdigest()
+		return cls._digests[cls]
+
+	@property
+	def fingerprint(self):
+		"""Hash of all the inputs of the rptok file, used to skip up to date tokens."""
+		md5 = hashlib.md5(self.sourcesDigest())
+		md5.update(json.dumps(self.js, sort_keys=True))
+		md5.update(json.dumps(sorted((name, asset.md5) for name, asset in self.assets.iteritems())))
+		md5.update(json.dumps([spell.js for spell in self.spells], sort_keys=True))
+		md5.update(str(args.delivery))
+		if args.thin: md5.update('thin')
+		return md5.hexdigest()
+
+	@property
+	def filename(self):
 		# directory hierarchy uses the monster type as subfolder
-		root = os.path.join('build', self.type)
-		try:
-			os.makedirs(root)
-		except OSError, e:
-			pass
-		filename = os.path.join(root, '%s.rptok'%(self.name.replace(":","_")))
+		return os.path.join('build', self.type, '%s.rptok'%(self.name.replace(":","_")))
+
+	def rptok(self):
+		"""Return the content of the rptok file."""
+		data = io.BytesIO()
 		# don't compress to avoid technical issue when sharing files
 		# the gain is very small anyway
-		with zipfile.ZipFile(filename, "w", zipfile.ZIP_STORED) as zipme:
+		with profiler.stage('Token.rptok', self.name), zipfile.ZipFile(data, "w", zipfile.ZIP_STORED) as zipme:
 			zipme.writestr('content.xml', self.content_xml.encode('utf-8'))
 			zipme.writestr('properties.xml', self.properties_xml.encode('utf-8'))
 			# default image for the token, right now it's a brown bear
 			# zip the xml file named with the md5 containing the asset properties
-			for name, asset in self.assets.iteritems():
-				zipme.writestr('assets/%s' % asset.md5, jenv().get_template('md5.template').render(name=name, extension='png', md5=asset.md5).encode("utf-8"))
-				zipme.writestr('assets/%s.png' % asset.md5, asset.bytes)
+			AssetRegistry(self.assets.iteritems()).zipme(zipme)
 			# build thumbnails
 			zipme.writestr('thumbnail', self.img.thumbnail(50,50).getvalue())
 			#dont include the large thumbnail, it will double the token size for no benefit
 			#zipme.writestr('thumbnail_large', self.img.thumbnail(500,500).getvalue())
+		return data.getvalue()
+
+	def zipme(self, data=None):
+		"""Zip the token into a rptok file, data is its content if already built."""
+		filename = self.filename
+		try:
+			os.makedirs(os.path.dirname(filename))
+		except OSError, e:
+			pass
+		data = data or self.rptok()
+		with profiler.stage('Token.zipme', self.name), open(filename, 'wb') as rptok:
+			rptok.write(data)
 		return filename
 
 	def verbose(self):
@@ -502,6 +626,7 @@ class Token(Dnd5ApiObject):
 		return v
 
 class LibToken(Token):
+	sources = Token.sources + ['macros/*.mtmacro']
 	def __init__(self, name):
 		Token.__init__(self, {'name': name, 'size': 'large'})
 	def __repr__(self): return 'LibToken<%s>' % self.name
@@ -711,27 +836,219 @@ def loadFromRst(fdata):
 	"legendary_actions": [{"name": field, "desc": value} for field, value in items["lactions"]],
 	}
 
+def monsterSources(srd=None):
+	"""Yield the monster source files, the tome of beasts directory is walked lazily.
+
+	srd is the list of SRD monsters to use instead of the 5e-database ones."""
+	yield r'../5e-database/5e-SRD-Monsters-volo.json'
+	yield srd or r'../5e-database/5e-SRD-Monsters.json'
+	tob = '../open5e/legacy-source-content/monsters/tome-of-beasts/'
+	for dp, dn, filenames in os.walk(tob):
+		for f in filenames:
+			if os.path.splitext(f)[1] == '.rst' and 'index' not in f: yield os.path.join(dp, f)
+
+def loadSource(fp):
+	"""Return the list of monsters defined in the source file."""
+	with codecs.open(fp, 'r', encoding='utf8') as mfile:
+		if fp.endswith('json'): return json.load(mfile)
+		if fp.endswith('rst'): return [loadFromRst(mfile)]
+	return []
+
+def loadMonsters(sources, cache=None, name=None):
+	"""Yield the monsters of the sources, one source at a time, filtered by the name pattern.
+
+	A source is a file or an already loaded list of monsters."""
+	pattern = re.compile(name, re.IGNORECASE) if name else None
+	for fp in sources:
+		if isinstance(fp, list): monsters = fp
+		else: monsters = cache.load(fp) if cache else loadSource(fp)
+		for monster in monsters:
+			if pattern is None or pattern.search(monster['name']): yield monster
+
+class DatasetCache(object):
+	"""Monsters parsed from the source files, stored one pickle per source.
+
+	An entry is valid for the same dataset version and loaders source, and the
+	same source mtime and size, or if these changed, the same source md5."""
+	# bump it whenever the entry format changes, the loaders changes are detected
+	version = 1
+	def __init__(self, root):
+		self.root = root
+		self.hits, self.misses = 0, 0
+		# the parsed monsters depend on the loaders code
+		self.loaders = hashlib.md5(''.join(inspect.getsource(loader) for loader in [loadSource, loadFromRst])).hexdigest()
+		if not os.path.exists(root): os.makedirs(root)
+
+	def __repr__(self): return 'DatasetCache<%s,hits=%s,misses=%s>' % (self.root, self.hits, self.misses)
+
+	def _dump(self, cfp, entry):
+		with open(cfp, 'wb') as cfile:
+			pickle.dump(entry, cfile, pickle.HIGHEST_PROTOCOL)
+
+	def load(self, fp):
+		"""Return the list of monsters of the source file, parse it only if it changed."""
+		st = os.stat(fp)
+		cfp = os.path.join(self.root, hashlib.md5(os.path.abspath(fp).encode('utf-8')).hexdigest()+'.pickle')
+		entry = None
+		try:
+			with open(cfp, 'rb') as cfile: entry = pickle.load(cfile)
+		except (IOError, EOFError, pickle.UnpicklingError): pass
+		if entry and (entry['version'], entry.get('loaders')) != (self.version, self.loaders): entry = None
+		if entry and (entry['mtime'], entry['size']) == (st.st_mtime, st.st_size):
+			self.hits += 1
+			return entry['monsters']
+		with open(fp, 'rb') as sfile: md5 = hashlib.md5(sfile.read()).hexdigest()
+		if entry and entry['md5'] == md5:
+			self.hits += 1
+		else:
+			self.misses += 1
+			log.info("parsing %s" % fp)
+			entry = {'version': self.version, 'loaders': self.loaders, 'md5': md5, 'monsters': loadSource(fp)}
+		entry.update(mtime=st.st_mtime, size=st.st_size)
+		self._dump(cfp, entry)
+		return entry['monsters']
+
+def _initWorker(_args, spells, _manifest):
+	"""Pool initializer, workers may not inherit the parent globals (spawn)."""
+	global args, manifest, writer
+	args = _args
+	manifest = _manifest
+	writer = None # a forked worker inherits the writer, not its thread
+	Spell.spellDB = spells
+	profiler.enabled, profiler.cprofile = args.profile, args.profile and args.cprofile
+	profiler.pop() # forked workers inherit the parent stats
+	configureImgCache(args.img_memory_size*2**20)
+	configureImgEncoder(args.img_max_size, args.img_colors, args.img_optimize)
+	configureAssetCache(args.img_cache, args.img_cache_size*2**20)
+	configureTemplateCache(args.template_cache)
+
+def upToDate(filename, fingerprint):
+	"""Return the content of the rptok file if it was built from these inputs and not changed since, None otherwise."""
+	entry = manifest.get(filename, None)
+	if not isinstance(entry, list) or entry[0] != fingerprint: return None
+	try:
+		with open(filename, 'rb') as rptok: data = rptok.read()
+	except IOError: return None
+	if hashlib.md5(data).hexdigest() != entry[1]:
+		log.warning("%s does not match its manifest entry, rebuilding it" % filename)
+		return None
+	return data
+
+def _zipToken(token):
+	"""Zip the token unless its rptok file is up to date, return (filename, entry, data).
+
+	entry is the manifest entry of the rptok file on disk, [fingerprint, md5],
+	the previous one if the file was not written (zip only). data is the rptok
+	content in delivery mode, None otherwise."""
+	log.info(token)
+	log.debug(token.verbose())
+	filename, fingerprint = token.filename, token.fingerprint
+	data = upToDate(filename, fingerprint)
+	if data is not None:
+		log.info("%s is up to date" % filename)
+		entry = manifest[filename]
+	else:
+		with profiler.stage('Token.build', token.name):
+			data = token.rptok()
+			entry = [fingerprint, hashlib.md5(data).hexdigest()]
+			if args.zip_only: entry = manifest.get(filename, None)
+			elif writer: writer.put(token.zipme, data)
+			else: token.zipme(data)
+	return filename, entry, data if args.delivery else None
+
+def _zipRemote(token):
+	"""Worker side of buildTokens, send back only what the campaign needs."""
+	return _zipToken(token) + (token.guid, token.assets, profiler.pop())
+
+def record(filename, entry):
+	"""Set the manifest entry of the rptok file, drop it if the file was never written."""
+	if entry is None: manifest.pop(filename, None)
+	else: manifest[filename] = entry
+
+def buildPool(jobs):
+	"""Return the pool of processes building the Token instances, None for jobs == 1.
+
+	It must be created before the writer thread, a forked process gets only the
+	forking thread but may inherit the locks the others hold."""
+	if jobs == 1: return None
+	return multiprocessing.Pool(jobs or None, _initWorker, (args, Spell.spellDB, manifest))
+
+def buildTokens(tokens, pool=None, window=32):
+	"""Zip the tokens into rptok files, yield (token, filename, data) in the tokens order.
+
+	Given a pool, Token instances are built by its processes, the other tokens
+	(POI, Lib) are built locally. At most window tokens are submitted ahead of
+	the one yielded, the tokens are read lazily."""
+	if pool is None:
+		for token in tokens:
+			filename, entry, data = _zipToken(token)
+			record(filename, entry)
+			yield token, filename, data
+		return
+	shared = {} # the same image is sent back by every worker, keep one copy of its bytes
+	def collect(token, result):
+		if result is None:
+			filename, entry, data = _zipToken(token)
+		else:
+			filename, entry, data, token._guid, token._assets, stats = result.get()
+			profiler.merge(stats)
+			for asset in token._assets.itervalues():
+				asset.bytes = shared.setdefault(asset.md5, asset.bytes)
+		record(filename, entry)
+		return token, filename, data
+	pending = collections.deque() # (token, async result or None if built locally), in the tokens order
+	try:
+		for token in tokens:
+			pending.append((token, pool.apply_async(_zipRemote, (token,)) if type(token) is Token else None))
+			if len(pending) > window: yield collect(*pending.popleft())
+		while pending: yield collect(*pending.popleft())
+	except:
+		pool.terminate()
+		pool.join()
+		raise
+
 def main():
 	parser = argparse.ArgumentParser(description='DnD 5e token builder')
 	parser.add_argument('--verbose', '-v', action='count')
 	parser.add_argument('--max-token', '-m', type=int)
 	parser.add_argument('--delivery', '-d', action="store_true", default=False)
-	global args
+	parser.add_argument('--zip-only', action="store_true", default=False, help='in delivery mode, write the tokens only in the delivery zip')
+	parser.add_argument('--thin', action="store_true", default=False, help='tokens call the sheet on Lib:Addon5e instead of embedding it')
+	parser.add_argument('--jobs', '-j', type=int, default=1, help='number of processes building the tokens, 0 for all the cores')
+	parser.add_argument('--io-queue', type=int, default=16, help='files waiting for the writer thread, 0 to write them in the build loop')
+	parser.add_argument('--img-cache', default=os.path.join('build', 'imgcache'), help='persistent image cache directory, empty to disable')
+	parser.add_argument('--img-cache-size', type=int, default=256, help='image cache size limit in MB')
+	parser.add_argument('--img-memory-size', type=int, default=128, help='in memory image cache size limit in MB')
+	parser.add_argument('--img-max-size', type=int, default=0, help='downscale the token images to fit in N pixels, 0 to keep their size')
+	parser.add_argument('--img-colors', type=int, default=0, help='quantize the token images to N colors (2-256), 0 to keep them in true colors')
+	parser.add_argument('--img-optimize', action="store_true", default=False, help='smaller and slower png encoding of the token images')
+	parser.add_argument('--template-cache', default=os.path.join('build', 'jinja'), help='compiled templates directory, empty to disable')
+	parser.add_argument('--name', '-n', help='build only the monsters matching this regular expression')
+	parser.add_argument('--dataset-cache', default=os.path.join('build', 'datasets'), help='parsed monster sources directory, empty to disable')
+	parser.add_argument('--refresh', action="store_true", default=False, help='refresh the stored monsters and spells from the api, the stored ones replace the SRD files')
+	parser.add_argument('--api', default=ubase, help='the dnd5 api base url')
+	parser.add_argument('--force', '-f', action="store_true", default=False, help='rebuild all tokens, even the up to date ones')
+	parser.add_argument('--shard', choices=['type', 'cr'], help='one zone per creature type or challenge rating band')
+	parser.add_argument('--zone-size', type=int, help='maximum number of tokens per zone')
+	parser.add_argument('--split-campaign', action="store_true", default=False, help='one campaign file per zone, each with the lib tokens')
+	parser.add_argument('--no-validate', dest='validate', action="store_false", default=True, help='do not parse the macros with the ModeMt grammar, by default the build fails on syntax errors')
+	parser.add_argument('--profile', action="store_true", default=False, help='time the build stages, report in build/profile.json')
+	parser.add_argument('--profile-top', type=int, default=20, help='number of slowest tokens to report')
+	parser.add_argument('--cprofile', action="store_true", default=False, help='with --profile, also run cProfile, one pstats file per stage in build/profile')
+	global args, writer
 	args = parser.parse_args()
+	if args.zip_only and not args.delivery: parser.error('--zip-only requires --delivery, the tokens are written only in the delivery zip')
+	profiler.enabled, profiler.cprofile = args.profile, args.profile and args.cprofile
 	if not os.path.exists('build'): os.makedirs('build')
-	localMonsters = []
-	tob = '../open5e/legacy-source-content/monsters/tome-of-beasts/'
-	sources = [
-		r'../5e-database/5e-SRD-Monsters-volo.json',
-		r'../5e-database/5e-SRD-Monsters.json',
-	]
-	sources += [os.path.join(dp, f) for dp, dn, filenames in os.walk(tob) for f in filenames if os.path.splitext(f)[1] == '.rst' and 'index' not in f]
-	for f in sources:
-		with codecs.open(f, 'r', encoding='utf8') as mfile:
-			if f.endswith('json'):
-				localMonsters += json.load(mfile)
-			if f.endswith('rst'):
-				localMonsters += [loadFromRst(mfile)]
+	configureImgCache(args.img_memory_size*2**20)
+	configureImgEncoder(args.img_max_size, args.img_colors, args.img_optimize)
+	acache = configureAssetCache(args.img_cache, args.img_cache_size*2**20)
+	configureTemplateCache(args.template_cache)
+	manifestFile = os.path.join('build', 'manifest.json')
+	if os.path.exists(manifestFile) and not args.force:
+		with open(manifestFile, 'r') as mfile:
+			manifest.update(json.load(mfile))
+	dcache = DatasetCache(args.dataset_cache) if args.dataset_cache else None
 
 	mLog = logging.getLogger()
 	mLog.setLevel(logging.DEBUG)
@@ -741,6 +1058,15 @@ def main():
 	fh.setFormatter(logging.Formatter('%(name)s : %(levelname)s : %(message)s'))
 	mLog.addHandler(fh)
 
+	if args.refresh:
+		for cls in [Token, Spell]:
+			cls.fetch('build', args.api)
+	# the last api refresh, if any, replaces the SRD monsters and spells
+	apiMonsters, apiSpells = Token.stored('build', 'api'), Spell.stored('build', 'api')
+	if apiMonsters: log.warning("Using %s monsters from the api" % len(apiMonsters))
+	if apiSpells: log.warning("Using %s spells from the api" % len(apiSpells))
+	localMonsters = loadMonsters(monsterSources(apiMonsters), dcache, args.name)
+
 	# generate the lib addon token
 	addon = LibToken('Lib:Addon5e')
 	fromFile = lambda path: jenv().get_template(path).render().encode("utf-8")
@@ -769,7 +1095,7 @@ def main():
 	{
 		[h, if( json.length( object ) > key ): 
 			macro.return = json.get( object, key ) ;
-			macro.return = default )]
+			macro.return = default ]
 	};{
 		[h: macro.return = default ]
 	}]
@@ -834,6 +1160,8 @@ def main():
 	[if (no_mod): jsaves = json.set(jsaves, Att ,default_mod)]
 }]
 [h: macro.return = jsaves]''', **params))
+	# the thin tokens call the sheet on the lib
+	if args.thin: addon.add(macros.SheetMacro(addon, thin=True))
 	addon.add(macros.Macro(addon, '', 'SaveMe', fromFile('saveme.mtmacro'), **params))
 	addon.add(macros.Macro(addon, '', 'CheckMe', fromFile('checkme.mtmacro'), **params))
 	params = {'group': 'aMenu'}
@@ -844,11 +1172,11 @@ def main():
 	params = {'group': 'Format'}
 	addon.add(macros.Macro(addon, '', 'cpanel', fromFile('cpanel.mtmacro'), **params))
 	addon.add(macros.Macro(addon, '', 'HTMLMacroButton','''[h:bgColor	= arg(1)]
-[h,if(argCount() > 5): shadow = arg(5); shadow = "")]
-[h,if(argCount() > 6): toolTip = arg(6); toolTip = "")]
-[h,if(argCount() > 7): args = arg(7); args = "[]")]
-[h,if(argCount() > 8): libType = arg(8); libType = "@this")]
-[h,if(argCount() > 9): output = arg(9); output = "none")]
+[h,if(argCount() > 5): shadow = arg(5); shadow = ""]
+[h,if(argCount() > 6): toolTip = arg(6); toolTip = ""]
+[h,if(argCount() > 7): args = arg(7); args = "[]"]
+[h,if(argCount() > 8): libType = arg(8); libType = "@this"]
+[h,if(argCount() > 9): output = arg(9); output = "none"]
 
 [h:btnformat	= strformat("padding:1px; border-width:1pt; border-style:solid; border-color:black; text-align:center; white-space:nowrap; background-image:url(%{shadow}); background-color:%{bgColor};")]
  
@@ -863,7 +1191,17 @@ def main():
 		</tr>
 	</table>
 </td>''' , **params))
-	filename = addon.zipme()
+	# 5e-database is probably a link
+	localSpells = apiSpells
+	if not localSpells:
+		with open(r'../5e-database/5e-SRD-Spells.json', 'r') as mfile:
+			localSpells = json.load(mfile)
+	Spell.spellDB = [Spell(spell) for spell in localSpells]
+	# the workers are given the spells, the writer thread starts after the fork
+	pool = buildPool(args.jobs)
+	window = 4*(args.jobs or multiprocessing.cpu_count()) # tokens submitted ahead to the pool
+	if args.io_queue: writer = Writer(args.io_queue)
+	_, filename, data = next(buildTokens([addon]))
 	log.warning("Done generating 1 library token: %s", addon)
 
 
@@ -871,44 +1209,76 @@ def main():
 	# fetch the monsters(token) and spells from dnd5Api or get them from the serialized file
 	#tokens = itertools.chain((Token(m) for m in monsters), Token.load('build'))
 	# dont use online api, use the fectched local database instead
-	tokens = itertools.chain([poi], (Token(m) for m in itertools.chain(localMonsters)))
-	# 5e-database is probably a link
-	with open(r'../5e-database/5e-SRD-Spells.json', 'r') as mfile:
-		localSpells = json.load(mfile)
-
-	Spell.spellDB = [Spell(spell) for spell in localSpells]
+	tokens = itertools.chain([poi], (Token(m) for m in localMonsters))
 
 	sTokens = [] # used for further serialization, because tokens is a generator and will be consumed
 	cnt = 0
 	deliveryFilename = 'build/dnd5eTokens.zip'
 	zfile = zipfile.ZipFile(deliveryFilename, "w", zipfile.ZIP_STORED) if args.delivery else None
+	# the delivery zip is written by the writer thread only, after the rptok files queued before
+	writestr = (lambda arcname, data: writer.put(zfile.writestr, arcname, data)) if writer else (zfile and zfile.writestr)
 	# add lib:addon5e to the zipfile
 	if zfile:
-		zfile.write(filename, os.path.relpath(filename, start='build'))
-	for token in itertools.islice(tokens, args.max_token):
-		log.info(token)
-		log.debug(token.verbose())
-		filename = token.zipme()
+		writestr(os.path.relpath(filename, start='build'), data)
+	for token, filename, data in buildTokens(itertools.islice(tokens, args.max_token), pool, window):
 		if zfile:
-			zfile.write(filename, os.path.relpath(filename, start='build'))
+			writestr(os.path.relpath(filename, start='build'), data)
 		sTokens.append(token)
 		if 'dft.png' in token.img.name: log.warning(str(token))
 		cnt += 1
+	if pool:
+		pool.close()
+		pool.join()
+	# the monsters are loaded lazily, by the build loop
+	if dcache:
+		profiler.count('datasetCache.hits', dcache.hits)
+		profiler.count('datasetCache.misses', dcache.misses)
+	# the manifest must not list files still in the queue
+	if writer:
+		writer.close()
+		log.info("Done writing files: %s" % writer)
+		writer = None
 	log.warning("Done generating %s tokens"%cnt)
+	if args.validate:
+		validator = validate.MacroValidator(os.path.join('build', 'macros.validate'), args.jobs)
+		with profiler.stage('validate'):
+			errors = validator.validate([addon] + sTokens)
+		log.warning("Done validating macros: %s" % validator)
+		if errors:
+			validate.report(errors)
+			# no manifest nor delivery zip for a failed build
+			if zfile:
+				zfile.close()
+				os.remove(deliveryFilename)
+			raise SystemExit("%s invalid macro commands" % len(errors))
+	with open(manifestFile, 'w') as mfile:
+		json.dump(manifest, mfile, indent=1, sort_keys=True)
 
 	log.warning("building campaign file")
-	zone = Zone('Library')
-	zone.build(sTokens + [addon])
-	cp = Campaign('demo5e')
-	cp.build([zone], [PSet('Basic', [])], [])
+	if args.split_campaign:
+		libs = [token for token in sTokens + [addon] if isinstance(token, LibToken)]
+		for name, group in shard((token for token in sTokens if not isinstance(token, LibToken)), args.shard, args.zone_size):
+			zone = Zone(name)
+			zone.build(group + libs)
+			cp = Campaign('demo5e_%s' % name.replace(' ', '_'))
+			cp.build([zone], [PSet('Basic', [])], [])
+	else:
+		zones = []
+		for name, group in shard(sTokens + [addon], args.shard, args.zone_size):
+			zones.append(Zone(name))
+			zones[-1].build(group)
+		cp = Campaign('demo5e')
+		cp.build(zones, [PSet('Basic', [])], [])
 	log.warning("Done building campaign file")
 
 	if zfile:
 		zfile.close()
 		log.warning("Done writing delivery zip file '%s'" % deliveryFilename)
 
-	Token.dump('build', sTokens)
+	Token.dump('build', (token for token in sTokens if type(token) is Token))
 	Spell.dump('build', Spell.spellDB)
+	if acache: acache.trim()
+	if args.profile: profiler.report(os.path.join('build', 'profile.json'), args.profile_top)
 
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.INFO)
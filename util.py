@@ -6,14 +6,32 @@ import os
 import hashlib
 import base64
 import uuid
+import re
+import difflib
+import collections
+import pickle
+import tempfile
+import time
+import json
+import cProfile
+import pstats
+import contextlib
+import threading
+import Queue
+import sys
 from PIL import Image
 try:
 	import coloredlogs # optional
 except ImportError: pass
+try:
+	import resource # not available on windows
+except ImportError: resource = None
 import logging
 
 # the jinja environment
 _jenv = None
+# named inline templates, name => source, compiled and cached by the jinja environment
+templates = {}
 
 # Name of the main logger
 lName = 'mtools'
@@ -46,34 +64,432 @@ def configureLogger(verbose):
 	fh.setFormatter(formatter)
 	mLog.addHandler(fh)
 
+class Profiler(object):
+	"""Time the build stages, per token and in aggregate, and count the cache hits.
+
+	Stages can be nested, their times are inclusive. The stage RSS growth is
+	how much the process peak RSS grew during the stage. With cprofile, the
+	outermost stages are also profiled by cProfile, one pstats file per stage
+	merging the main process and the workers."""
+	def __init__(self):
+		self.enabled = False
+		self.cprofile = False
+		self._active = False # a cProfile is running
+		self._lock = threading.Lock() # stages also run in the writer thread
+		self._remote = {} # stage => pstats.Stats of the workers
+		self.pop()
+
+	def __repr__(self): return 'Profiler<%s stages, %s tokens>' % (len(self.stages), len(self.tokens))
+
+	@contextlib.contextmanager
+	def stage(self, name, token=None):
+		"""Time the with block as the stage name, on behalf of the token name if given."""
+		if not self.enabled:
+			yield
+			return
+		profile = None
+		if self.cprofile and not self._active and isinstance(threading.current_thread(), threading._MainThread):
+			profile = self._profiles.setdefault(name, cProfile.Profile())
+			self._active = True
+			profile.enable()
+		start, rss = time.time(), peakRss()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - start
+			if profile:
+				profile.disable()
+				self._active = False
+			with self._lock:
+				stats = self.stages.setdefault(name, {'calls': 0, 'time': 0.0, 'max': 0.0, 'rss_growth_kb': 0})
+				stats['calls'] += 1
+				stats['time'] += elapsed
+				stats['max'] = max(stats['max'], elapsed)
+				stats['rss_growth_kb'] += peakRss() - rss
+				if token is not None:
+					times = self.tokens.setdefault(token, {})
+					times[name] = times.get(name, 0.0) + elapsed
+
+	def count(self, name, n=1):
+		if self.enabled:
+			with self._lock: self.counters[name] += n
+
+	def pop(self):
+		"""Return the collected data and start over, workers send it to the main process."""
+		profiles = {}
+		for name, profile in getattr(self, '_profiles', {}).iteritems():
+			profile.create_stats()
+			profiles[name] = profile.stats
+		state = getattr(self, 'stages', None), getattr(self, 'tokens', None), getattr(self, 'counters', None), profiles
+		self.stages, self.tokens, self.counters = {}, {}, collections.Counter()
+		self._profiles = {} # stage => cProfile.Profile
+		return state
+
+	def merge(self, state):
+		stages, tokens, counters, profiles = state
+		for name, other in stages.iteritems():
+			stats = self.stages.setdefault(name, {'calls': 0, 'time': 0.0, 'max': 0.0, 'rss_growth_kb': 0})
+			for key in ['calls', 'time', 'rss_growth_kb']: stats[key] += other[key]
+			stats['max'] = max(stats['max'], other['max'])
+		for token, other in tokens.iteritems():
+			times = self.tokens.setdefault(token, {})
+			for name, elapsed in other.iteritems(): times[name] = times.get(name, 0.0) + elapsed
+		self.counters.update(counters)
+		for name, raw in profiles.iteritems():
+			if name in self._remote: self._remote[name].add(RawStats(raw))
+			else: self._remote[name] = pstats.Stats(RawStats(raw))
+
+	def report(self, fp, top=20, total='Token.build'):
+		"""Write the json report in fp, log the top slowest tokens by their total stage."""
+		# an up to date token does no work, only the timed ones are listed
+		slowest = sorted(((token, times) for token, times in self.tokens.iteritems() if times.get(total, 0) > 0),
+			key=lambda item: item[1][total], reverse=True)[:top]
+		with open(fp, 'w') as rfile:
+			json.dump({'stages': self.stages, 'counters': self.counters, 'peak_rss_kb': peakRss(),
+				'slowest': [dict(times, token=token) for token, times in slowest]}, rfile, indent=1, sort_keys=True)
+		if self.cprofile:
+			root = os.path.splitext(fp)[0]
+			if not os.path.exists(root): os.makedirs(root)
+			for name in set(self._profiles) | set(self._remote):
+				stats = self._remote.get(name, None)
+				if name in self._profiles:
+					if stats: stats.add(self._profiles[name])
+					else: stats = pstats.Stats(self._profiles[name])
+				stats.dump_stats(os.path.join(root, name+'.pstats'))
+		lines = ['%-24s %8s %10s %10s %12s' % ('stage', 'calls', 'total(s)', 'max(s)', 'rss grow(kb)')]
+		lines += ['%-24s %8d %10.3f %10.3f %12d' % (name, st['calls'], st['time'], st['max'], st['rss_growth_kb']) for name, st in sorted(self.stages.iteritems())]
+		lines += ['%-24s %8d' % (name, n) for name, n in sorted(self.counters.iteritems())]
+		lines += ['%-24s %12d' % ('process peak rss(kb)', peakRss())]
+		if slowest:
+			lines += ['', '%-40s %10s' % ('slowest tokens', total+'(s)')]
+			lines += ['%-40s %10.3f' % (token, times[total]) for token, times in slowest]
+		log.warning("Profile written in %s\n%s" % (fp, '\n'.join(lines)))
+
+class RawStats(object):
+	"""The cProfile stats sent back by a worker, as a pstats.Stats source."""
+	def __init__(self, stats): self.stats = stats
+	def create_stats(self): pass
+
+def peakRss():
+	"""The process peak RSS in kB, 0 if unknown."""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+# the build profiler, disabled by default
+profiler = Profiler()
+
+class Environment(jinja2.Environment):
+	"""A jinja environment counting the template lookups for the profiler."""
+	def get_template(self, name, parent=None, globals=None):
+		profiler.count('template.lookups')
+		return jinja2.Environment.get_template(self, name, parent, globals)
+
+class Loader(jinja2.ChoiceLoader):
+	"""A ChoiceLoader counting the template loads (environment cache misses) for the profiler."""
+	def load(self, environment, name, globals=None):
+		profiler.count('template.loads')
+		return jinja2.ChoiceLoader.load(self, environment, name, globals)
+
 def jenv():
 	"""Return a jinja environment."""
 	global _jenv # pylint: disable= W0603
 	if _jenv is None:
-		_jenv = jinja2.Environment(loader=jinja2.FileSystemLoader(['macros', 'templates']))
+		# the named templates are a small fixed set, they are never evicted
+		_jenv = Environment(loader=Loader([
+			jinja2.DictLoader(templates),
+			jinja2.FileSystemLoader(['macros', 'templates']),
+		]), cache_size=-1)
 		_jenv.filters['json2mt'] = lambda s: s.replace(r"\"", r"\'")
 	return _jenv
 
-# a cache for the Images
-imgCache = {}
+class TemplateCache(object):
+	"""Anonymous templates compiled from their source, least recently used first out of size.
+
+	They bypass the bytecode cache, most of them are used once (the macro
+	commands embedding the token stat block)."""
+	def __init__(self, size):
+		self.size = size
+		self.items = collections.OrderedDict() # source md5 => jinja Template
+		self._lock = threading.Lock()
+
+	def __repr__(self): return 'TemplateCache<%s/%s items>' % (len(self.items), self.size)
+	def __len__(self): return len(self.items)
+
+	def get(self, source):
+		"""Return the template compiled from source."""
+		key = hashlib.md5(source.encode('utf-8') if isinstance(source, unicode) else source).hexdigest()
+		with self._lock:
+			template = self.items.pop(key, None)
+			if template is not None: self.items[key] = template # most recently used
+		profiler.count('template.inline.misses' if template is None else 'template.inline.hits')
+		if template is None:
+			template = jenv().from_string(source)
+			with self._lock:
+				self.items[key] = template
+				while len(self.items) > self.size: self.items.popitem(last=False)
+		return template
+
+	def clear(self):
+		with self._lock: self.items.clear()
+
+def configureTemplateCache(root):
+	"""Store the compiled templates in the root directory, disable if root is empty."""
+	if root and not os.path.exists(root): os.makedirs(root)
+	jenv().bytecode_cache = jinja2.FileSystemBytecodeCache(root) if root else None
+
+# the anonymous templates, see inlineTemplate
+inlineTemplates = TemplateCache(256)
+
+def inlineTemplate(source):
+	"""Return the template compiled from source."""
+	return inlineTemplates.get(source)
+
+class ImgCache(object):
+	"""The encoded images of the build, keyed by the source path.
+
+	Only the png bytes, their md5 and the image size are kept, least recently
+	used first out of max_bytes."""
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.items = collections.OrderedDict() # fp => (md5, size, data)
+		self.hits, self.misses, self.evictions = 0, 0, 0
+		self._lock = threading.Lock()
+
+	def __repr__(self): return 'ImgCache<%s items, %s bytes,hits=%s,misses=%s>' % (len(self.items), self.bytes, self.hits, self.misses)
+	def __len__(self): return len(self.items)
+	def __contains__(self, fp): return fp in self.items
+
+	def get(self, fp):
+		"""Return (md5, size, data) of the source file, None if not cached."""
+		with self._lock:
+			item = self.items.pop(fp, None)
+			if item is None: self.misses += 1
+			else:
+				self.hits += 1
+				self.items[fp] = item # most recently used
+		profiler.count('imgCache.misses' if item is None else 'imgCache.hits')
+		return item
+
+	def put(self, fp, md5, size, data):
+		if len(data) > self.max_bytes: return
+		with self._lock:
+			old = self.items.pop(fp, None)
+			if old: self.bytes -= len(old[2])
+			self.items[fp] = (md5, size, data)
+			self.bytes += len(data)
+			self._trim()
+
+	def _trim(self):
+		while self.bytes > self.max_bytes:
+			_, (_, _, evicted) = self.items.popitem(last=False)
+			self.bytes -= len(evicted)
+			self.evictions += 1
+			profiler.count('imgCache.evictions')
+
+	def resize(self, max_bytes):
+		with self._lock:
+			self.max_bytes = max_bytes
+			self._trim()
+
+	def clear(self):
+		with self._lock:
+			self.items.clear()
+			self.bytes = 0
+
+	def metrics(self):
+		with self._lock:
+			return {'items': len(self.items), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+				'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class ImgEncoder(object):
+	"""Encode the source images as the png assets of the tokens.
+
+	Images larger than max_size are downscaled to fit, MapTool renders them at
+	the grid size anyway. colors quantizes them to a palette, optimize is the
+	slower and smaller png encoding. 0 and False keep the image as is."""
+	def __init__(self, max_size=0, colors=0, optimize=False):
+		self.max_size = max_size
+		self.colors = colors
+		self.optimize = optimize
+
+	def __repr__(self): return 'ImgEncoder<%s>' % self.key
+
+	@property
+	def key(self): return 'max_size=%s,colors=%s,optimize=%s' % (self.max_size, self.colors, self.optimize)
+
+	def encode(self, fp):
+		"""Return the png bytes and the size of the encoded image."""
+		_bytes = io.BytesIO()
+		with Image.open(fp) as img:
+			if self.max_size and max(img.size) > self.max_size:
+				img.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+			if self.colors:
+				img = img.convert('RGBA').quantize(self.colors, method=Image.FASTOCTREE)
+			img.save(_bytes, format='png', optimize=self.optimize)
+			return _bytes.getvalue(), img.size
+
+# a cache for the Images, see configureImgCache
+imgCache = ImgCache(128*2**20)
+# the image encoding settings, see configureImgEncoder
+_encoder = ImgEncoder()
+# the persistent asset cache, see configureAssetCache
+_acache = None
+
+def configureImgCache(max_bytes):
+	"""Set the in memory image cache size limit."""
+	imgCache.resize(max_bytes)
+	return imgCache
+
+def configureImgEncoder(max_size=0, colors=0, optimize=False):
+	"""Set the image encoding settings, the images encoded with other settings are dropped."""
+	global _encoder # pylint: disable= W0603
+	encoder = ImgEncoder(max_size, colors, optimize)
+	if encoder.key != _encoder.key: imgCache.clear()
+	_encoder = encoder
+	return _encoder
+
+def configureAssetCache(root, max_bytes):
+	"""Enable the persistent asset cache in the root directory, disable it if root is empty."""
+	global _acache # pylint: disable= W0603
+	_acache = AssetCache(root, max_bytes) if root else None
+	return _acache
+
+def assetCache():
+	"""Return the persistent asset cache, None if disabled."""
+	return _acache
+
+class AssetCache(object):
+	"""A persistent cache of Img data shared between builds.
+
+	Records are keyed by the source path, mtime, size and the encoding settings, they
+	point to content addressed png blobs (the encoded image and its thumbnails). Every access
+	touches the files, trim() evicts the least recently used ones. Writes trim the cache when
+	it outgrows max_bytes, the size is estimated between two trims, other processes may write
+	in the same directory."""
+	def __init__(self, root, max_bytes):
+		self.root = root
+		self.max_bytes = max_bytes
+		self.hits, self.misses = 0, 0
+		self.total = None # bytes in the cache, scanned on the first write
+		if not os.path.exists(root): os.makedirs(root)
+
+	def __repr__(self): return "AssetCache<%s,hits=%s,misses=%s>" % (self.root, self.hits, self.misses)
+
+	def _key(self, fp):
+		st = os.stat(fp)
+		return hashlib.md5(('%s|%r|%s|%s' % (os.path.abspath(fp), st.st_mtime, st.st_size, _encoder.key)).encode('utf-8')).hexdigest()
+
+	def _path(self, name): return os.path.join(self.root, name)
+
+	def _read(self, name):
+		path = self._path(name)
+		try:
+			with open(path, 'rb') as f: data = f.read()
+		except IOError: return None
+		os.utime(path, None)
+		return data
+
+	def _write(self, name, data):
+		path = self._path(name)
+		# unique per process and thread, the app writes from concurrent requests
+		fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+		with os.fdopen(fd, 'wb') as f: f.write(data)
+		try:
+			os.rename(tmp, path)
+		except OSError: # windows won't rename over an existing file
+			try:
+				os.remove(path)
+			except OSError: pass # removed by an other writer
+			try:
+				os.rename(tmp, path)
+			except OSError: # written by an other writer meanwhile, with the same content
+				os.remove(tmp)
+		if self.total is None: self.total = sum(size for _, size, _ in self._files())
+		self.total += len(data)
+		# trim below the limit, not to scan the directory again on the next write
+		if self.total > self.max_bytes: self.trim(self.max_bytes*9/10)
+
+	def _record(self, fp):
+		data = self._read(self._key(fp)+'.rec')
+		return pickle.loads(data) if data else None
+
+	def get(self, fp):
+		"""Return the record {'md5', 'size', 'thumbs'} of the source file, None if not cached."""
+		record = self._record(fp)
+		if record is None: self.misses += 1
+		else: self.hits += 1
+		profiler.count('assetCache.misses' if record is None else 'assetCache.hits')
+		return record
+
+	def blob(self, md5):
+		"""Return the png bytes for the given md5, None if evicted."""
+		return self._read(md5+'.png')
+
+	def put(self, fp, data, size, thumbs=None):
+		"""Cache the png bytes of the source file, return its record."""
+		record = {'md5': hashlib.md5(data).hexdigest(), 'size': size, 'thumbs': thumbs or {}}
+		self._write(record['md5']+'.png', data)
+		self._write(self._key(fp)+'.rec', pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+		return record
+
+	def thumbnail(self, fp, xy):
+		"""Return the cached thumbnail bytes of the source file, None if not cached."""
+		record = self._record(fp)
+		md5 = record and record['thumbs'].get(xy, None)
+		return self.blob(md5) if md5 else None
+
+	def putThumbnail(self, fp, xy, data):
+		record = self._record(fp)
+		if record is None: return
+		md5 = hashlib.md5(data).hexdigest()
+		self._write(md5+'.png', data)
+		record['thumbs'][xy] = md5
+		self._write(self._key(fp)+'.rec', pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+	def _files(self):
+		"""Return the (mtime, size, name) of the cached files, not the ones being written."""
+		files = []
+		for name in os.listdir(self.root):
+			if name.endswith('.tmp'): continue
+			try:
+				st = os.stat(self._path(name))
+			except OSError: continue # evicted by an other process
+			files.append((st.st_mtime, st.st_size, name))
+		return files
+
+	def trim(self, max_bytes=None):
+		"""Evict the least recently used files until the cache fits in max_bytes, the cache limit by default."""
+		max_bytes = self.max_bytes if max_bytes is None else max_bytes
+		files = self._files()
+		total = sum(size for _, size, _ in files)
+		for mtime, size, name in sorted(files):
+			if total <= max_bytes: break
+			try:
+				os.remove(self._path(name))
+			except OSError: pass # evicted by an other process
+			total -= size
+		self.total = total
+		log.info("%s trimmed to %s bytes" % (self, total))
 
 class Img(object):
 	"""A PIL.Image higher layer for MT assets."""
 	def __init__(self, fp):
 		self.fp = fp
-		# first try to get the img and byte array from the cache
-		img, byteArray = imgCache.get(fp, (None, None))
-		if img is None:
-			# not in the cache, let's build the img
-			_bytes = io.BytesIO()
-			img = Image.open(fp)
-			img.save(_bytes, format='png')
-			byteArray = _bytes.getvalue()
-			imgCache[fp] = (img, byteArray)
+		# first try to get the md5, size and byte array from the caches
+		item = imgCache.get(fp)
+		if item is None:
+			cache = assetCache()
+			record = cache and cache.get(fp)
+			byteArray = record and cache.blob(record['md5'])
+			if byteArray is None:
+				# not in the cache, let's build the img, the decoded image is released right away
+				with profiler.stage('Img.encode'):
+					byteArray, size = _encoder.encode(fp)
+				record = cache.put(fp, byteArray, size) if cache else {'md5': hashlib.md5(byteArray).hexdigest(), 'size': size}
+			item = record['md5'], tuple(record['size']), byteArray
+			imgCache.put(fp, *item)
 		# store the byte content, md5 for further use
-		self.bytes = byteArray
-		self._md5 = hashlib.md5(self.bytes).hexdigest()
-		self.x, self.y = img.size
+		self._md5, (self.x, self.y), self.bytes = item
 
 	def resize(self, x,y):
 		self.bytes = self.thumbnail(100,100).getvalue()
@@ -89,12 +505,164 @@ class Img(object):
 	def md5(self): return self._md5
 
 	def thumbnail(self, x,y):
+		cache = assetCache()
+		data = cache and cache.thumbnail(self.fp, (x,y))
+		if data is not None: return io.BytesIO(data)
 		thumb = io.BytesIO()
-		img = Image.open(self.fp)
-		img.thumbnail((x,y))
-		img.save(thumb, format='png')
+		with profiler.stage('Img.thumbnail'):
+			with Image.open(self.fp) as img:
+				img.thumbnail((x,y))
+				img.save(thumb, format='png')
+		if cache: cache.putThumbnail(self.fp, (x,y), thumb.getvalue())
 		return thumb
 
+class AssetRegistry(object):
+	"""Assets keyed by md5, each one is stored once whatever the number of references."""
+	def __init__(self, items=()):
+		self.assets = collections.OrderedDict() # md5 => (name, asset), first reference wins
+		self.refs = 0
+		self.referenced_bytes = 0
+		self.update(items)
+
+	def __repr__(self):
+		return "AssetRegistry<%s unique/%s refs, %s/%s bytes>" % (len(self), self.refs, self.unique_bytes, self.referenced_bytes)
+	def __len__(self): return len(self.assets)
+	def __iter__(self): return self.assets.itervalues()
+
+	def add(self, name, asset):
+		self.refs += 1
+		self.referenced_bytes += len(asset.bytes)
+		self.assets.setdefault(asset.md5, (name, asset))
+
+	def update(self, items):
+		"""Add (name, asset) items, or all the assets of another registry."""
+		if isinstance(items, AssetRegistry):
+			for name, asset in items: self.assets.setdefault(asset.md5, (name, asset))
+			self.refs += items.refs
+			self.referenced_bytes += items.referenced_bytes
+		else:
+			for name, asset in items: self.add(name, asset)
+
+	@property
+	def unique_bytes(self): return sum(len(asset.bytes) for _, asset in self)
+
+	def zipme(self, zfile):
+		"""Write every asset once, its properties and its png file."""
+		template = jenv().get_template('md5.template')
+		for name, asset in self:
+			zfile.writestr('assets/%s' % asset.md5, template.render(name=name, extension='png', md5=asset.md5).encode('utf-8'))
+			zfile.writestr('assets/%s.png' % asset.md5, asset.bytes)
+
+class ImgIndex(object):
+	"""A name index over image files, to find the file best matching a token name.
+
+	Lookups are exact name, normalized name, then a difflib ratio computed only
+	on the files sharing the most n-grams with the name."""
+	def __init__(self, files, n=3, shortlist=50):
+		self.n = n
+		self.shortlist = shortlist
+		self.files = list(files)
+		self.names = [os.path.splitext(os.path.basename(f))[0].lower() for f in self.files]
+		self.exact = {}
+		self.normalized = {}
+		self.grams = collections.defaultdict(list) # ngram => file indexes
+		self.sizes = [] # number of ngrams per file
+		for index, name in enumerate(self.names):
+			self.exact.setdefault(name, index)
+			self.normalized.setdefault(self.normalize(name), index)
+			grams = self.ngrams(name)
+			self.sizes.append(len(grams))
+			for gram in grams: self.grams[gram].append(index)
+
+	def __repr__(self): return "ImgIndex<%s files>" % len(self.files)
+	def __len__(self): return len(self.files)
+
+	@staticmethod
+	def normalize(name): return re.sub(r'[\W_]+', ' ', name.lower()).strip()
+
+	def ngrams(self, name):
+		name = ' %s ' % name
+		return set(name[i:i+self.n] for i in range(len(name)-self.n+1))
+
+	def match(self, name):
+		"""Return the tuple (fpath, ratio) of the best match, ('', 0) if the index is empty."""
+		name = name.lower()
+		index = self.exact.get(name, self.normalized.get(self.normalize(name), None))
+		if index is not None: return self.files[index], 1.0
+		grams = self.ngrams(name)
+		shared = collections.Counter(i for gram in grams for i in self.grams.get(gram, []))
+		# dice coefficient on the n-grams, favors names of similar length
+		score = lambda i: 2.0*shared[i]/(len(grams)+self.sizes[i])
+		candidates = sorted(sorted(shared, key=score, reverse=True)[:self.shortlist])
+		best, bratio = '', 0
+		sm = difflib.SequenceMatcher()
+		sm.set_seq2(name) # seq2 is the one difflib caches
+		for i in candidates:
+			sm.set_seq1(self.names[i])
+			if sm.real_quick_ratio() <= bratio or sm.quick_ratio() <= bratio: continue
+			ratio = sm.ratio()
+			if ratio > bratio: best, bratio = self.files[i], ratio
+		return best, bratio
+
+def zipChunks(zfile, arcname, chunks):
+	"""Write the byte chunks into the zip entry arcname, without joining them in memory.
+
+	python2 zipfile cannot open an entry for writing, chunks are spooled into a
+	temporary file that zipfile copies by blocks."""
+	fd, tmp = tempfile.mkstemp(suffix='.zipchunks')
+	try:
+		with os.fdopen(fd, 'wb') as spool:
+			for chunk in chunks: spool.write(chunk)
+		zfile.write(tmp, arcname)
+	finally:
+		os.remove(tmp)
+
+class Writer(object):
+	"""Run the file and zip writes in a thread, in order, overlapping them with the build.
+
+	The queue is bounded: put blocks when maxsize writes are pending, keeping
+	the pending data in memory bounded. The first error stops the writes, it is raised by put and close."""
+	def __init__(self, maxsize=16):
+		self.queue = Queue.Queue(maxsize)
+		self.error = None
+		self.writes = 0
+		self.thread = threading.Thread(target=self._run, name='writer')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def __repr__(self): return 'Writer<%s writes, %s pending>' % (self.writes, self.queue.qsize())
+
+	def __enter__(self): return self
+	def __exit__(self, *exc): self.close()
+
+	def _run(self):
+		while True:
+			job = self.queue.get()
+			if job is None: return
+			if self.error is not None: continue # drain the queue
+			func, args = job
+			try:
+				func(*args)
+				self.writes += 1
+			except Exception:
+				self.error = sys.exc_info()
+
+	def _raise(self):
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+
+	def put(self, func, *args):
+		"""Call func(*args) in the writer thread."""
+		self._raise()
+		self.queue.put((func, args))
+
+	def close(self):
+		"""Wait for the pending writes."""
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+		self._raise()
+
 def guid():
 	"""Return a serialized GUID, it's an uuid4 encoded in base64."""
 	return base64.b64encode(uuid.uuid4().bytes)
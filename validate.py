@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import hashlib
+import pickle
+import collections
+import multiprocessing
+
+from util import getLogger
+
+log = getLogger(__name__)
+
+# the macro commands are parsed with the ModeMt grammar of test/antlr/mt, its
+# python parser, and their roll options are checked by the mt module
+grammarDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'antlr', 'mt')
+mt = None # the test/antlr/mt module, imported on first use
+
+def importMt():
+	"""Import and return the mt module, from the grammar directory."""
+	global mt # pylint: disable= W0603
+	if mt is None:
+		sys.path.insert(0, grammarDir)
+		try:
+			import mt as module
+		except ImportError, e:
+			raise RuntimeError("Cannot validate the macros, the mt module in %s does not import: %s" % (grammarDir, e))
+		finally:
+			sys.path.remove(grammarDir)
+		mt = module
+	return mt
+
+def grammarDigest():
+	"""md5 of the grammar and its parser, a parse result is valid for the parser it was parsed with."""
+	md5 = hashlib.md5()
+	for name in ['ModeMtLexer.g4', 'ModeMtParser.g4', 'mtparse.py', 'mt.py']:
+		with open(os.path.join(grammarDir, name), 'rb') as gfile: md5.update(gfile.read())
+	return md5.hexdigest()
+
+def check(command):
+	"""Parse the macro command, return None if valid, (line, column, message) otherwise."""
+	module = importMt()
+	try:
+		module.parse(command)
+	except module.MtSyntaxError, e:
+		return e.line, e.column, e.msg
+	return None
+
+class MacroValidator(object):
+	"""Parse the macro commands with the ModeMt grammar, each distinct command once.
+
+	The parse results are stored in fp, keyed by the command md5."""
+	def __init__(self, fp=None, jobs=1):
+		importMt()
+		self.fp = fp
+		self.jobs = jobs
+		self.results = {} # command md5 => None or (line, column, message)
+		self.hits, self.misses = 0, 0
+		digest = grammarDigest()
+		if fp and os.path.exists(fp):
+			try:
+				with open(fp, 'rb') as vfile: cached = pickle.load(vfile)
+				if cached['grammar'] == digest: self.results = cached['results']
+			except (IOError, EOFError, KeyError, pickle.UnpicklingError): pass
+		self.digest = digest
+
+	def __repr__(self): return 'MacroValidator<%s commands,hits=%s,misses=%s>' % (len(self.results), self.hits, self.misses)
+
+	def validate(self, tokens):
+		"""Return the errors as (command, (line, column, message), [(token, macro), ...]), in the tokens order."""
+		usages, commands = [], {} # (token, macro, md5), md5 => command
+		for token in tokens:
+			for macro in token.macros:
+				command = macro.command
+				md5 = hashlib.md5(command.encode('utf-8')).hexdigest()
+				commands.setdefault(md5, command)
+				usages.append((token, macro, md5))
+		missing = [md5 for md5 in commands if md5 not in self.results]
+		self.hits, self.misses = len(commands)-len(missing), len(missing)
+		log.info("Validating %s macros, %s distinct commands, %s to parse" % (len(usages), len(commands), len(missing)))
+		if self.jobs == 1 or len(missing) < 2:
+			parsed = [check(commands[md5]) for md5 in missing]
+		else:
+			pool = multiprocessing.Pool(self.jobs or None)
+			try:
+				parsed = pool.map(check, [commands[md5] for md5 in missing], chunksize=8)
+				pool.close()
+			except:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+		self.results.update(zip(missing, parsed))
+		if self.fp and missing:
+			with open(self.fp, 'wb') as vfile:
+				pickle.dump({'grammar': self.digest, 'results': self.results}, vfile, pickle.HIGHEST_PROTOCOL)
+		errors = collections.OrderedDict() # md5 => usages of the invalid command
+		for token, macro, md5 in usages:
+			if self.results[md5]: errors.setdefault(md5, []).append((token, macro))
+		return [(commands[md5], self.results[md5], used) for md5, used in errors.iteritems()]
+
+def report(errors):
+	"""Log the errors, pointing at the offending line and column."""
+	for command, (line, column, message), used in errors:
+		lines = command.splitlines() or ['']
+		source = lines[min(line, len(lines))-1]
+		pointer = ''.join(c if c == '\t' else ' ' for c in source[:column])
+		where = ', '.join("%s '%s'" % (token.name, macro.label) for token, macro in used[:3])
+		if len(used) > 3: where += ' and %s more' % (len(used)-3)
+		log.error("%s line %s:%s %s\n\t%s\n\t%s^" % (where, line, column, message, source, pointer))
@@ -1,13 +1,45 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
+
 #from mtoken import Map
-from util import jenv, getLogger, guid
+from util import jenv, getLogger, guid, AssetRegistry, profiler
 
 log = getLogger(__name__)
 
+# challenge rating bands, (highest CR, zone name)
+crBands = [(1, 'CR 0-1'), (4, 'CR 2-4'), (10, 'CR 5-10'), (16, 'CR 11-16'), (None, 'CR 17+')]
+
+def crBand(token):
+	"""The CR band name of the token, None if it has no CR (lib tokens)."""
+	cr = token.js.get('challenge_rating', None)
+	if cr is None: return None
+	try:
+		cr = 0 if '/' in unicode(cr) else float(cr)
+	except ValueError: return None
+	return next(name for top, name in crBands if top is None or cr <= top)
+
+def shard(tokens, by=None, size=None):
+	"""Split the tokens in one pass into named groups, by 'type' or 'cr', then in chunks of size tokens.
+
+	Yield (name, tokens), tokens without type or CR go in the Library group."""
+	keys = {'type': lambda tok: tok.type.capitalize(), 'cr': crBand, None: lambda tok: None}[by]
+	groups = collections.OrderedDict()
+	for tok in tokens:
+		groups.setdefault(keys(tok) or 'Library', []).append(tok)
+	for name, group in groups.iteritems():
+		if not size or len(group) <= size:
+			yield name, group
+			continue
+		for index in xrange(0, len(group), size):
+			yield '%s %s' % (name, index/size+1), group[index:index+size]
+
 class Zone(object):
 	sentinel = object()
+	# size class => (x, y, cell size) in pixels, the band of rows of the class starts at y
+	offsets = collections.OrderedDict([("Lib", (50, 50,150)), ("tiny",(50,150,50)), ("small", (50,200,50)), ("medium", (50,250,50)), ("large",(50,300,100)), ("huge", (50,400,150)), ("gargantuan", (50,550,200))])
+	width = 2500 # rows longer than this wrap, pushing the next bands down
 	def __init__(self, name):
 		self.name = name
 		self.tokens = []
@@ -20,6 +52,11 @@ class Zone(object):
 		if self._guid is self.sentinel: self._guid = guid()
 		return self._guid
 
+	@property
+	def assets(self):
+		"""The tokens assets, named after their file."""
+		return AssetRegistry((asset.name, asset) for tok in self.tokens for asset in tok.assets.itervalues())
+
 	@property
 	def content_xml(self):
 		return jenv().get_template('zone_content.template').render(zone=self) or u''
@@ -27,15 +64,22 @@ class Zone(object):
 	def render(self): return self.content_xml
 
 	def build(self, tokens):
-		"""Build a campaign given the tokens, properties all json data."""
-		offsets = {"Lib": (50, 50,150), "tiny":(50,150,50), "small": (50,200,50), "medium": (50,250,50), "large":(50,300,100), "huge": (50,400,150), "gargantuan": (50,550,200)}
-		by_type = lambda token_list, _type: (t for t in token_list if ("Lib" if t.type=="Lib" else t.size.lower())==_type)
-		for _type in offsets:
-			for index, tok in enumerate(by_type(tokens, _type)):
-				x,y,xscale = offsets[_type]
-				tok.x = x + (index)*xscale
-				tok.y = y 
-				log.debug("Placing %s at x=%s y=%s" % (tok, tok.x, tok.y))
+		"""Place the tokens on a grid, one band of rows per size class, and add them to the zone."""
+		with profiler.stage('Zone.build'):
+			buckets = collections.OrderedDict((_type, []) for _type in self.offsets)
+			for tok in tokens:
+				_type = "Lib" if tok.type=="Lib" else tok.size.lower()
+				if _type in buckets: buckets[_type].append(tok)
+				else: log.warning("Cannot place %s, unknown size %s" % (tok, _type))
+			shift = 0 # the extra rows of the previous bands
+			for _type, toks in buckets.iteritems():
+				x, y, cell = self.offsets[_type]
+				columns = max(1, (self.width-x)/cell)
+				for index, tok in enumerate(toks):
+					tok.x = x + (index%columns)*cell
+					tok.y = y + shift + (index/columns)*cell
+					log.debug("Placing %s at x=%s y=%s" % (tok, tok.x, tok.y))
+				shift += max(0, (len(toks)-1)/columns)*cell
 		#main_scene = Map()
 		#main_scene.name = 'empty_page_blue'
 		#main_scene.y = 0